@@ -24,7 +24,7 @@ from api.db import FileType, ParserType, FileSource
 from api.db.db_models import APIToken, API4Conversation, Task, File
 from api.db.services import duplicate_name
 from api.db.services.api_service import APITokenService, API4ConversationService
-from api.db.services.dialog_service import DialogService, chat
+from api.db.services.dialog_service import DialogService, chat, delta_stream
 from api.db.services.document_service import DocumentService
 from api.db.services.file2document_service import File2DocumentService
 from api.db.services.file_service import FileService
@@ -185,6 +185,8 @@ def completion():
             return get_data_error_result(retmsg="Dialog not found!")
         del req["conversation_id"]
         del req["messages"]
+        # 增量模式下每个事件只带新增的文本，最后一个事件带完整回答和引用
+        delta = req.pop("delta", False)
 
         if not conv.reference:
             conv.reference = []
@@ -206,8 +208,10 @@ def completion():
         def stream():
             nonlocal dia, msg, req, conv
             try:
-                for ans in chat(dia, msg, True, **req):
-                    fillin_conv(ans)
+                answers = chat(dia, msg, True, **req)
+                for ans in delta_stream(answers) if delta else answers:
+                    if not ans.get("delta"):
+                        fillin_conv(ans)
                     rename_field(ans)
                     yield "data:" + json.dumps({"retcode": 0, "retmsg": "", "data": ans}, ensure_ascii=False) + "\n\n"
                 API4ConversationService.append_message(conv.id, conv.to_dict())
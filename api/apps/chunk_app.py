@@ -157,10 +157,14 @@ def set():
             d = beAdoc(d, arr[0], arr[1], not any(
                 [rag_tokenizer.is_chinese(t) for t in q + a]))
 
+        ck = ELASTICSEARCH.get(req["chunk_id"], search.index_name(tenant_id))
+        d["term_weights_with_weight"] = retrievaler.term_weights(dict(ck.get("_source", {}), **d))
+
         v, c = embd_mdl.encode([doc.name, req["content_with_weight"]])
         v = 0.1 * v[0] + 0.9 * v[1] if doc.parser_id != ParserType.QA else v[1]
         d["q_%d_vec" % len(v)] = v.tolist()
         ELASTICSEARCH.upsert([d], search.index_name(tenant_id))
+        search.bump_kb_version(doc.kb_id)
         return get_json_result(data=True)
     except Exception as e:
         return server_error_response(e)
@@ -178,6 +182,9 @@ def switch():
         if not ELASTICSEARCH.upsert([{"id": i, "available_int": int(req["available_int"])} for i in req["chunk_ids"]],
                                     search.index_name(tenant_id)):
             return get_data_error_result(retmsg="Index updating failure")
+        e, doc = DocumentService.get_by_id(req["doc_id"])
+        if e:
+            search.bump_kb_version(doc.kb_id)
         return get_json_result(data=True)
     except Exception as e:
         return server_error_response(e)
@@ -189,9 +196,24 @@ def switch():
 def rm():
     req = request.json
     try:
+        kb_ids = []
+        if req.get("doc_id"):
+            e, doc = DocumentService.get_by_id(req["doc_id"])
+            if e:
+                kb_ids = [doc.kb_id]
+        if not kb_ids:
+            try:
+                ck = ELASTICSEARCH.get(req["chunk_ids"][0], search.index_name(current_user.id))
+                kb_ids = ck.get("_source", {}).get("kb_id", [])
+            except Exception as e:
+                pass
+        if not kb_ids:
+            # no telling which KB the chunks were in, every one of the tenant's is stale
+            kb_ids = [kb.id for kb in KnowledgebaseService.query(tenant_id=current_user.id)]
         if not ELASTICSEARCH.deleteByQuery(
                 Q("ids", values=req["chunk_ids"]), search.index_name(current_user.id)):
             return get_data_error_result(retmsg="Index updating failure")
+        search.bump_kb_version(kb_ids)
         return get_json_result(data=True)
     except Exception as e:
         return server_error_response(e)
@@ -220,6 +242,7 @@ def create():
         d["kb_id"] = [doc.kb_id]
         d["docnm_kwd"] = doc.name
         d["doc_id"] = doc.id
+        d["term_weights_with_weight"] = retrievaler.term_weights(d)
 
         tenant_id = DocumentService.get_tenant_id(req["doc_id"])
         if not tenant_id:
@@ -234,6 +257,7 @@ def create():
         v = 0.1 * v[0] + 0.9 * v[1]
         d["q_%d_vec" % len(v)] = v.tolist()
         ELASTICSEARCH.upsert([d], search.index_name(tenant_id))
+        search.bump_kb_version(doc.kb_id)
 
         DocumentService.increment_chunk_num(
             doc.id, doc.kb_id, c, 1, 0)
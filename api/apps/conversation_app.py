@@ -16,7 +16,7 @@
 from copy import deepcopy
 from flask import request, Response
 from flask_login import login_required
-from api.db.services.dialog_service import DialogService, ConversationService, chat
+from api.db.services.dialog_service import DialogService, ConversationService, chat, delta_stream
 from api.utils.api_utils import server_error_response, get_data_error_result, validate_request
 from api.utils import get_uuid
 from api.utils.api_utils import get_json_result
@@ -129,6 +129,8 @@ def completion():
             return get_data_error_result(retmsg="Dialog not found!")
         del req["conversation_id"]
         del req["messages"]
+        # 增量模式下每个事件只带新增的文本，最后一个事件带完整回答和引用
+        delta = req.pop("delta", False)
 
         if not conv.reference:
             conv.reference = []
@@ -145,8 +147,10 @@ def completion():
         def stream():
             nonlocal dia, msg, req, conv
             try:
-                for ans in chat(dia, msg, True, **req):
-                    fillin_conv(ans)
+                answers = chat(dia, msg, True, **req)
+                for ans in delta_stream(answers) if delta else answers:
+                    if not ans.get("delta"):
+                        fillin_conv(ans)
                     yield "data:"+json.dumps({"retcode": 0, "retmsg": "", "data": ans}, ensure_ascii=False) + "\n\n"
                 ConversationService.update_by_id(conv.id, conv.to_dict())
             except Exception as e:
@@ -295,6 +295,7 @@ def change_status():
                                               idxnm=search.index_name(
                                                   kb.tenant_id)
                                               )
+        search.bump_kb_version(doc.kb_id)
         return get_json_result(data=True)
     except Exception as e:
         return server_error_response(e)
@@ -357,16 +358,30 @@ def run():
             tenant_id = DocumentService.get_tenant_id(id)
             if not tenant_id:
                 return get_data_error_result(retmsg="Tenant not found!")
-            ELASTICSEARCH.deleteByQuery(
-                Q("match", doc_id=id), idxnm=search.index_name(tenant_id))
+            e, doc = DocumentService.get_by_id(id)
+            # incremental re-parses drop the stale chunks themselves, see task_executor.incremental()
+            incremental = str(req["run"]) == TaskStatus.RUNNING.value and doc.parser_config.get("incremental_reindex") \
+                and not (doc.type != FileType.PDF.value and doc.parser_id == ParserType.TABLE.value)
+            if not incremental:
+                ELASTICSEARCH.deleteByQuery(
+                    Q("match", doc_id=id), idxnm=search.index_name(tenant_id))
+                search.bump_kb_version(doc.kb_id)
 
             if str(req["run"]) == TaskStatus.RUNNING.value:
                 TaskService.filter_delete([Task.doc_id == id])
-                e, doc = DocumentService.get_by_id(id)
                 doc = doc.to_dict()
                 doc["tenant_id"] = tenant_id
                 bucket, name = File2DocumentService.get_minio_address(doc_id=doc["id"])
-                queue_tasks(doc, bucket, name)
+                tsks = queue_tasks(doc, bucket, name)
+                if incremental and doc["type"] == FileType.PDF.value:
+                    # tasks only diff the chunks of their own pages, drop the ones of the pages
+                    # no task parses any more: the PDF got shorter or parser_config.pages narrowed
+                    covered = [Q("range", page_num_int={"gte": t["from_page"] + 1, "lte": t["to_page"]}) for t in tsks]
+                    if any([t["from_page"] == 0 for t in tsks]):
+                        covered.append(~Q("exists", field="page_num_int"))
+                    ELASTICSEARCH.deleteByQuery(
+                        Q("bool", must=[Q("match", doc_id=id)], must_not=covered), idxnm=search.index_name(tenant_id))
+                    search.bump_kb_version(doc["kb_id"])
 
         return get_json_result(data=True)
     except Exception as e:
@@ -460,7 +475,11 @@ def change_parser():
             return get_data_error_result(retmsg="Document not found!")
         if "parser_config" in req:
             DocumentService.update_parser_config(doc.id, req["parser_config"])
-        if doc.token_num > 0:
+        # same parser, incremental re-parse: the chunks are diffed when it runs, see run()
+        incremental = doc.parser_id.lower() == req["parser_id"].lower() \
+            and (doc.parser_config.get("incremental_reindex") or req.get("parser_config", {}).get("incremental_reindex")) \
+            and not (doc.type != FileType.PDF.value and doc.parser_id == ParserType.TABLE.value)
+        if doc.token_num > 0 and not incremental:
             e = DocumentService.increment_chunk_num(doc.id, doc.kb_id, doc.token_num * -1, doc.chunk_num * -1,
                                                     doc.process_duation * -1)
             if not e:
@@ -470,6 +489,7 @@ def change_parser():
                 return get_data_error_result(retmsg="Tenant not found!")
             ELASTICSEARCH.deleteByQuery(
                 Q("match", doc_id=doc.id), idxnm=search.index_name(tenant_id))
+            search.bump_kb_version(doc.kb_id)
 
         return get_json_result(data=True)
     except Exception as e:
@@ -15,7 +15,7 @@
 #
 from flask import request
 from flask_login import login_required, current_user
-from api.db.services.llm_service import LLMFactoriesService, TenantLLMService, LLMService
+from api.db.services.llm_service import LLMFactoriesService, TenantLLMService, LLMService, MODEL_INSTANCE_CACHE
 from api.utils.api_utils import server_error_response, get_data_error_result, validate_request
 from api.db import StatusEnum, LLMType
 from api.db.db_models import TenantLLM
@@ -99,6 +99,7 @@ def set_api_key():
                 api_key=req["api_key"],
                 api_base=req.get("base_url", "")
             )
+    MODEL_INSTANCE_CACHE.invalidate(current_user.id)
 
     return get_json_result(data=True)
 
@@ -165,6 +166,7 @@ def add_llm():
     if not TenantLLMService.filter_update(
             [TenantLLM.tenant_id == current_user.id, TenantLLM.llm_factory == factory, TenantLLM.llm_name == llm["llm_name"]], llm):
         TenantLLMService.save(**llm)
+    MODEL_INSTANCE_CACHE.invalidate(current_user.id)
 
     return get_json_result(data=True)
 
@@ -176,6 +178,7 @@ def delete_llm():
     req = request.json
     TenantLLMService.filter_delete(
             [TenantLLM.tenant_id == current_user.id, TenantLLM.llm_factory == req["llm_factory"], TenantLLM.llm_name == req["llm_name"]])
+    MODEL_INSTANCE_CACHE.invalidate(current_user.id)
     return get_json_result(data=True)
 
 
@@ -16,9 +16,11 @@
 from flask_login import login_required
 
 from api.db.services.knowledgebase_service import KnowledgebaseService
+from api.db.services.llm_service import MODEL_INSTANCE_CACHE
 from api.utils.api_utils import get_json_result
 from api.versions import get_rag_version
 from rag.settings import SVR_QUEUE_NAME
+from rag.utils import http_conn
 from rag.utils.es_conn import ELASTICSEARCH
 from rag.utils.minio_conn import MINIO
 from timeit import default_timer as timer
@@ -65,4 +67,8 @@ def status():
     except Exception as e:
         res["redis"] = {"status": "red", "elapsed": "{:.1f}".format((timer() - st)*1000.), "error": str(e)}
 
+    # 模型服务的连接复用情况
+    res["http"] = http_conn.stats()
+    res["llm_cache"] = MODEL_INSTANCE_CACHE.stats()
+
     return get_json_result(data=res)
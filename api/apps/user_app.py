@@ -22,7 +22,7 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import login_required, current_user, login_user, logout_user
 
 from api.db.db_models import TenantLLM
-from api.db.services.llm_service import TenantLLMService, LLMService
+from api.db.services.llm_service import TenantLLMService, LLMService, MODEL_INSTANCE_CACHE
 from api.utils.api_utils import server_error_response, validate_request
 from api.utils import get_uuid, get_format_time, decrypt, download_img, current_timestamp, datetime_format
 from api.db import UserTenantRole, LLMType, FileType
@@ -386,6 +386,8 @@ def set_tenant_info():
         tid = req["tenant_id"]
         del req["tenant_id"]
         TenantService.update_by_id(tid, req)
+        # 默认模型变了
+        MODEL_INSTANCE_CACHE.invalidate(tid)
         return get_json_result(data=True)
     except Exception as e:
         return server_error_response(e)
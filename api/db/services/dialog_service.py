@@ -13,9 +13,14 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import os
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 
+import numpy as np
+
 from api.db import LLMType
 from api.db.db_models import Dialog, Conversation
 from api.db.services.common_service import CommonService
@@ -36,6 +41,89 @@ class ConversationService(CommonService):
     model = Conversation
 
 
+CITATION_EMBD_POOL = ThreadPoolExecutor(max_workers=int(os.environ.get("CITATION_EMBD_WORKERS", 4)))
+RETRIEVAL_POOL = ThreadPoolExecutor(max_workers=int(os.environ.get("RETRIEVAL_WORKERS", 8)))
+# 自RAG对每个问题都预先改写并检索一次，多一次LLM调用和检索，换掉串行等待，默认关闭
+SELF_RAG_SPECULATIVE = int(os.environ.get("SELF_RAG_SPECULATIVE", 0)) > 0
+
+
+class CitationEmbedder:
+    """
+    Embeds the finished sentences of an answer in the background while it
+    is still being streamed, so that insert_citations(), given this object
+    as its embedding model, finds most of them ready when the answer ends.
+    """
+    def __init__(self, embd_mdl):
+        self.embd_mdl = embd_mdl
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.fed = 0
+        self.ended = False
+
+    def feed(self, answer):
+        # a piece is finished by a sentence end and the text following it
+        new = answer[self.fed:]
+        end = re.search(r"[；。？!！\n.?;`]", new) is not None
+        if not new or not (end or self.ended):
+            return
+        self.fed = len(answer)
+        self.ended = end
+        # the last piece may still grow
+        pieces, idx, pieces_ = retrievaler.split_answer(answer)
+        pieces_ = [t for i, t in zip(idx, pieces_) if i < len(pieces) - 1]
+        with self.lock:
+            todo = [t for t in dict.fromkeys(pieces_) if t not in self.pending]
+            if not todo:
+                return
+            fut = CITATION_EMBD_POOL.submit(self.embd_mdl.encode, todo)
+            for i, t in enumerate(todo):
+                self.pending[t] = (fut, i)
+
+    def encode(self, texts):
+        vects, missing = {}, []
+        with self.lock:
+            pending = [(t, self.pending.get(t)) for t in texts]
+        for t, p in pending:
+            if p is None:
+                missing.append(t)
+                continue
+            try:
+                vects[t] = p[0].result()[0][p[1]]
+            except Exception as e:
+                chat_logger.warning("Citation embedding: " + str(e))
+                missing.append(t)
+        tk_count = 0
+        missing = list(dict.fromkeys(missing))
+        if missing:
+            vts, tk_count = self.embd_mdl.encode(missing)
+            for t, v in zip(missing, vts):
+                vects[t] = v
+        return np.array([vects[t] for t in texts]), tk_count
+
+
+def delta_stream(answers):
+    """
+    Turns the cumulative answers of chat(stream=True) into events carrying
+    only the text added since the previous event:
+    {"answer": new_text, "delta": True, "reference": {}}.
+    The last answer, with citations and references, is passed on whole, as
+    is any answer that does not extend the previous one.
+    """
+    sent, last = "", None
+    for ans in answers:
+        if last is not None:
+            txt = last["answer"]
+            if txt.startswith(sent):
+                if len(txt) > len(sent):
+                    yield {"answer": txt[len(sent):], "delta": True, "reference": {}}
+            else:
+                yield last
+            sent = txt
+        last = ans
+    if last is not None:
+        yield last
+
+
 def message_fit_in(msg, max_length=4000):
     def count():
         nonlocal msg
@@ -124,31 +212,39 @@ def chat(dialog, messages, stream=True, **kwargs):
     # 将问题复制一遍，用于检索
     for _ in range(len(questions) // 2):
         questions.append(questions[-1])
+    def retrieve(questions):
+        return retrievaler.retrieval(" ".join(questions), embd_mdl, dialog.tenant_id, dialog.kb_ids, 1, dialog.top_n,
+                                     dialog.similarity_threshold,
+                                     dialog.vector_similarity_weight,
+                                     doc_ids=kwargs["doc_ids"].split(",") if "doc_ids" in kwargs else None,
+                                     top=1024, aggs=False, rerank_mdl=rerank_mdl)
+
+    # 自RAG：改写问题并用改写后的问题检索，与第一次检索和相关性判断同时进行
+    def rewrite_and_retrieve(questions):
+        questions[-1] = rewrite(dialog.tenant_id, dialog.llm_id, questions[-1])
+        return questions, retrieve(questions)
+
+    self_rag = dialog.prompt_config.get("self_rag")
+    need_knowledge = "knowledge" in [p["key"] for p in prompt_config["parameters"]]
+    speculative = None
+    if self_rag and need_knowledge and SELF_RAG_SPECULATIVE:
+        speculative = RETRIEVAL_POOL.submit(rewrite_and_retrieve, list(questions))
     # 如果提示词配置中没有knowledge参数，则初始化检索结果
-    if "knowledge" not in [p["key"] for p in prompt_config["parameters"]]:
+    if not need_knowledge:
         kbinfos = {"total": 0, "chunks": [], "doc_aggs": []}
     else:
         # 检索
         chat_logger.info(f"Starting retrieval with params: tenant_id={dialog.tenant_id}, kb_ids={dialog.kb_ids}")
-        # print(f"Starting retrieval with params: tenant_id={dialog.tenant_id}, kb_ids={dialog.kb_ids}")
-        kbinfos = retrievaler.retrieval(" ".join(questions), embd_mdl, dialog.tenant_id, dialog.kb_ids, 1, dialog.top_n,
-                                        dialog.similarity_threshold,
-                                        dialog.vector_similarity_weight,
-                                        doc_ids=kwargs["doc_ids"].split(",") if "doc_ids" in kwargs else None,
-                                        top=1024, aggs=False, rerank_mdl=rerank_mdl)
-        # print("Retrieval results:", kbinfos)
+        kbinfos = retrieve(questions)
         chat_logger.info(f"Retrieval results: {kbinfos}")
     # 获取检索结果
     knowledges = [ck["content_with_weight"] for ck in kbinfos["chunks"]]
-    # print("knowledges:", knowledges)
     # 如果提示词配置中启用了自RAG，则重写问题并重新检索
-    if dialog.prompt_config.get("self_rag") and not relevant(dialog.tenant_id, dialog.llm_id, questions[-1], knowledges):
-        questions[-1] = rewrite(dialog.tenant_id, dialog.llm_id, questions[-1])
-        kbinfos = retrievaler.retrieval(" ".join(questions), embd_mdl, dialog.tenant_id, dialog.kb_ids, 1, dialog.top_n,
-                                        dialog.similarity_threshold,
-                                        dialog.vector_similarity_weight,
-                                        doc_ids=kwargs["doc_ids"].split(",") if "doc_ids" in kwargs else None,
-                                        top=1024, aggs=False, rerank_mdl=rerank_mdl)
+    if self_rag and not relevant(dialog.tenant_id, dialog.llm_id, questions[-1], knowledges):
+        if speculative:
+            questions, kbinfos = speculative.result()
+        else:
+            questions, kbinfos = rewrite_and_retrieve(questions)
         knowledges = [ck["content_with_weight"] for ck in kbinfos["chunks"]]
     # 打印检索结果
     chat_logger.info(
@@ -172,16 +268,17 @@ def chat(dialog, messages, stream=True, **kwargs):
         gen_conf["max_tokens"] = min(
             gen_conf["max_tokens"],
             max_tokens - used_token_count)
+    quote = knowledges and (prompt_config.get("quote", True) and kwargs.get("quote", True))
     # 装饰答案
-    def decorate_answer(answer):
+    def decorate_answer(answer, embedder=None):
         nonlocal prompt_config, knowledges, kwargs, kbinfos
-        if knowledges and (prompt_config.get("quote", True) and kwargs.get("quote", True)):
+        if quote:
             answer, idx = retrievaler.insert_citations(answer,
                                                        [ck["content_ltks"]
                                                         for ck in kbinfos["chunks"]],
                                                        [ck["vector"]
                                                         for ck in kbinfos["chunks"]],
-                                                       embd_mdl,
+                                                       embedder or embd_mdl,
                                                        tkweight=1 - dialog.vector_similarity_weight,
                                                        vtweight=dialog.vector_similarity_weight)
             idx = set([kbinfos["chunks"][int(i)]["doc_id"] for i in idx])
@@ -193,7 +290,7 @@ def chat(dialog, messages, stream=True, **kwargs):
         refs = deepcopy(kbinfos)
         # 删除检索结果中的vector
         for c in refs["chunks"]:
-            if c.get("vector"):
+            if "vector" in c:
                 del c["vector"]
         # 如果答案中包含无效密钥，则添加提示信息
         if answer.lower().find("invalid key") >= 0 or answer.lower().find("invalid api") >= 0:
@@ -203,10 +300,14 @@ def chat(dialog, messages, stream=True, **kwargs):
     # 如果启用了流式输出，则逐个生成答案
     if stream:
         answer = ""
+        # 生成过程中在后台计算已完成句子的向量，用于插入引用
+        embedder = CitationEmbedder(embd_mdl) if quote else None
         for ans in chat_mdl.chat_streamly(msg[0]["content"], msg[1:], gen_conf):
             answer = ans
+            if embedder:
+                embedder.feed(answer)
             yield {"answer": answer, "reference": {}}
-        yield decorate_answer(answer)
+        yield decorate_answer(answer, embedder)
     else:
         # 否则，一次性生成答案
         answer = chat_mdl.chat(
@@ -78,6 +78,7 @@ class DocumentService(CommonService):
     def remove_document(cls, doc, tenant_id):
         ELASTICSEARCH.deleteByQuery(
                 Q("match", doc_id=doc.id), idxnm=search.index_name(tenant_id))
+        search.bump_kb_version(doc.kb_id)
         cls.clear_chunk_num(doc.id)
         return cls.delete_by_id(doc.id)
 
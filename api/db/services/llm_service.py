@@ -13,8 +13,18 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import atexit
+import os
+import threading
+import time
+from functools import reduce
+
+from cachetools import TTLCache
+from peewee import Case
+
 from api.db.services.user_service import TenantService
 from api.settings import database_logger
+from rag.utils.redis_conn import REDIS_CONN
 from rag.llm import EmbeddingModel, CvModel, ChatModel, RerankModel
 from api.db import LLMType
 from api.db.db_models import DB, UserTenant
@@ -59,8 +69,7 @@ class TenantLLMService(CommonService):
 
     @classmethod
     @DB.connection_context()
-    def model_instance(cls, tenant_id, llm_type,
-                       llm_name=None, lang="Chinese"):
+    def model_config(cls, tenant_id, llm_type, llm_name=None):
         e, tenant = TenantService.get_by_id(tenant_id)
         if not e:
             raise LookupError("Tenant not found")
@@ -93,6 +102,25 @@ class TenantLLMService(CommonService):
                     if not mdlnm:
                         raise LookupError(f"Type of {llm_type} model is not set.")
                     raise LookupError("Model({}) not authorized".format(mdlnm))
+        return model_config
+
+    @staticmethod
+    def model_key(tenant_id, model_config):
+        """
+        Identifies the model behind a config across tenants: models of the
+        built-in factories are the same for everyone, the others are the
+        tenant's own, whatever their name.
+        """
+        key = [model_config["llm_factory"], model_config.get("api_base") or "", model_config["llm_name"]]
+        if model_config["llm_factory"] not in ["Youdao", "FastEmbed", "BAAI"]:
+            key.insert(0, str(tenant_id))
+        return "/".join(key)
+
+    @classmethod
+    def model_instance(cls, tenant_id, llm_type,
+                       llm_name=None, lang="Chinese", model_config=None):
+        if not model_config:
+            model_config = cls.model_config(tenant_id, llm_type, llm_name)
 
         if llm_type == LLMType.EMBEDDING.value:
             if model_config["llm_factory"] not in EmbeddingModel:
@@ -120,26 +148,30 @@ class TenantLLMService(CommonService):
             return ChatModel[model_config["llm_factory"]](
                 model_config["api_key"], model_config["llm_name"], base_url=model_config["api_base"])
 
-    @classmethod
-    @DB.connection_context()
-    def increase_usage(cls, tenant_id, llm_type, used_tokens, llm_name=None):
-        e, tenant = TenantService.get_by_id(tenant_id)
-        if not e:
-            raise LookupError("Tenant not found")
-
+    @staticmethod
+    def usage_model_name(tenant, llm_type, llm_name=None):
         if llm_type == LLMType.EMBEDDING.value:
-            mdlnm = tenant.embd_id
+            return tenant.embd_id
         elif llm_type == LLMType.SPEECH2TEXT.value:
-            mdlnm = tenant.asr_id
+            return tenant.asr_id
         elif llm_type == LLMType.IMAGE2TEXT.value:
-            mdlnm = tenant.img2txt_id
+            return tenant.img2txt_id
         elif llm_type == LLMType.CHAT.value:
-            mdlnm = tenant.llm_id if not llm_name else llm_name
+            return tenant.llm_id if not llm_name else llm_name
         elif llm_type == LLMType.RERANK:
-            mdlnm = tenant.llm_id if not llm_name else llm_name
+            return tenant.llm_id if not llm_name else llm_name
         else:
             assert False, "LLM type error"
 
+    @classmethod
+    @DB.connection_context()
+    def increase_usage(cls, tenant_id, llm_type, used_tokens, llm_name=None):
+        e, tenant = TenantService.get_by_id(tenant_id)
+        if not e:
+            raise LookupError("Tenant not found")
+
+        mdlnm = cls.usage_model_name(tenant, llm_type, llm_name)
+
         num = 0
         try:
             for u in cls.query(tenant_id = tenant_id, llm_name=mdlnm):
@@ -150,6 +182,30 @@ class TenantLLMService(CommonService):
             pass
         return num
 
+    @classmethod
+    @DB.connection_context()
+    def increase_usage_batch(cls, usages):
+        """
+        usages: {(tenant_id, llm_type, llm_name): used_tokens}.
+        Adds them up per model row and writes them in one UPDATE.
+        Returns (number of rows updated, number of rows to update).
+        """
+        tenants = {t.id: t for t in TenantService.get_by_ids(list(set([k[0] for k in usages.keys()])))}
+        rows = {}
+        for (tenant_id, llm_type, llm_name), n in usages.items():
+            if tenant_id not in tenants:
+                database_logger.error("Can't update token usage, tenant {} not found".format(tenant_id))
+                continue
+            k = (tenant_id, cls.usage_model_name(tenants[tenant_id], llm_type, llm_name))
+            rows[k] = rows.get(k, 0) + n
+        if not rows:
+            return 0, 0
+        conds = [(cls.model.tenant_id == t) & (cls.model.llm_name == m) for t, m in rows.keys()]
+        num = cls.model.update(used_tokens=cls.model.used_tokens + Case(None, list(zip(conds, rows.values())), 0))\
+            .where(reduce(lambda a, b: a | b, conds))\
+            .execute()
+        return num, len(rows)
+
     @classmethod
     @DB.connection_context()
     def get_openai_models(cls):
@@ -161,66 +217,158 @@ class TenantLLMService(CommonService):
         return list(objs)
 
 
+def llm_version_key(tenant_id): return f"tenant_llm_version:{tenant_id}"
+
+
+class ModelInstanceCache:
+    """
+    The model objects of LLMBundle, with their max token length, by tenant,
+    type, model name and language. invalidate() drops the ones of a tenant
+    in every process, by bumping a version number kept in Redis.
+    """
+    def __init__(self, maxsize=1024, ttl=600):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def version(tenant_id):
+        return REDIS_CONN.get(llm_version_key(tenant_id)) if REDIS_CONN.is_alive() else None
+
+    def get(self, tenant_id, llm_type, llm_name=None, lang="Chinese", version=None):
+        if version is None:
+            version = self.version(tenant_id)
+        k = (tenant_id, llm_type, llm_name, lang, version)
+        with self.lock:
+            v = self.cache.get(k) if self.cache.maxsize > 0 else None
+            if v is not None:
+                self.hits += 1
+                return v
+            self.misses += 1
+        model_config = TenantLLMService.model_config(tenant_id, llm_type, llm_name)
+        mdl = TenantLLMService.model_instance(tenant_id, llm_type, llm_name, lang=lang, model_config=model_config)
+        model_key = TenantLLMService.model_key(tenant_id, model_config)
+        max_length = 512
+        for lm in LLMService.query(llm_name=llm_name):
+            max_length = lm.max_tokens
+            break
+        if mdl and self.cache.maxsize > 0:
+            with self.lock:
+                self.cache[k] = (mdl, max_length, model_key)
+        return mdl, max_length, model_key
+
+    def invalidate(self, tenant_id):
+        with self.lock:
+            for k in [k for k in self.cache.keys() if k[0] == tenant_id]:
+                self.cache.pop(k, None)
+        REDIS_CONN.incr(llm_version_key(tenant_id))
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"size": len(self.cache), "maxsize": self.cache.maxsize,
+                    "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / total if total else 0.}
+
+
+MODEL_INSTANCE_CACHE = ModelInstanceCache(
+    maxsize=int(os.environ.get("LLM_CACHE_SIZE", 1024)),
+    ttl=int(os.environ.get("LLM_CACHE_TTL", 600)))
+
+
+class UsageAccumulator:
+    """
+    Token usage of LLMBundle calls, added up in memory per tenant and model
+    and written by a background thread every `interval` seconds in one
+    UPDATE. Also written at exit, so no count is lost on shutdown.
+    """
+    def __init__(self, interval=10):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.thread = None
+        atexit.register(self.flush)
+
+    def add(self, tenant_id, llm_type, used_tokens, llm_name=None):
+        if not used_tokens:
+            return
+        if self.interval <= 0:
+            if not TenantLLMService.increase_usage(tenant_id, llm_type, used_tokens, llm_name):
+                database_logger.error("Can't update token usage for {}/{}".format(tenant_id, llm_type))
+            return
+        k = (tenant_id, llm_type, llm_name)
+        with self.lock:
+            self.pending[k] = self.pending.get(k, 0) + int(used_tokens)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        try:
+            num, rows = TenantLLMService.increase_usage_batch(pending)
+            if num < rows:
+                database_logger.error("Can't update token usage of {} model(s)".format(rows - num))
+        except Exception as e:
+            database_logger.error("Can't update token usage: " + str(e))
+            # 下次再写
+            with self.lock:
+                for k, n in pending.items():
+                    self.pending[k] = self.pending.get(k, 0) + n
+
+
+USAGE = UsageAccumulator(interval=int(os.environ.get("USAGE_FLUSH_INTERVAL", 10)))
+
+
 class LLMBundle(object):
     def __init__(self, tenant_id, llm_type, llm_name=None, lang="Chinese"):
         self.tenant_id = tenant_id
         self.llm_type = llm_type
         self.llm_name = llm_name
-        self.mdl = TenantLLMService.model_instance(
-            tenant_id, llm_type, llm_name, lang=lang)
+        # changes whenever the tenant's model settings do
+        self.llm_version = MODEL_INSTANCE_CACHE.version(tenant_id)
+        self.mdl, self.max_length, self.model_key = MODEL_INSTANCE_CACHE.get(
+            tenant_id, llm_type, llm_name, lang=lang, version=self.llm_version)
         assert self.mdl, "Can't find mole for {}/{}/{}".format(
             tenant_id, llm_type, llm_name)
-        self.max_length = 512
-        for lm in LLMService.query(llm_name=llm_name):
-            self.max_length = lm.max_tokens
-            break
 
     def encode(self, texts: list, batch_size=32):
         emd, used_tokens = self.mdl.encode(texts, batch_size)
-        if not TenantLLMService.increase_usage(
-                self.tenant_id, self.llm_type, used_tokens):
-            database_logger.error(
-                "Can't update token usage for {}/EMBEDDING".format(self.tenant_id))
+        USAGE.add(self.tenant_id, self.llm_type, used_tokens)
         return emd, used_tokens
 
     def encode_queries(self, query: str):
         emd, used_tokens = self.mdl.encode_queries(query)
-        if not TenantLLMService.increase_usage(
-                self.tenant_id, self.llm_type, used_tokens):
-            database_logger.error(
-                "Can't update token usage for {}/EMBEDDING".format(self.tenant_id))
+        USAGE.add(self.tenant_id, self.llm_type, used_tokens)
         return emd, used_tokens
 
     def similarity(self, query: str, texts: list):
         sim, used_tokens = self.mdl.similarity(query, texts)
-        if not TenantLLMService.increase_usage(
-                self.tenant_id, self.llm_type, used_tokens):
-            database_logger.error(
-                "Can't update token usage for {}/RERANK".format(self.tenant_id))
+        USAGE.add(self.tenant_id, self.llm_type, used_tokens)
         return sim, used_tokens
 
     def describe(self, image, max_tokens=300):
         txt, used_tokens = self.mdl.describe(image, max_tokens)
-        if not TenantLLMService.increase_usage(
-                self.tenant_id, self.llm_type, used_tokens):
-            database_logger.error(
-                "Can't update token usage for {}/IMAGE2TEXT".format(self.tenant_id))
+        USAGE.add(self.tenant_id, self.llm_type, used_tokens)
         return txt
 
     def chat(self, system, history, gen_conf):
         txt, used_tokens = self.mdl.chat(system, history, gen_conf)
-        if not TenantLLMService.increase_usage(
-                self.tenant_id, self.llm_type, used_tokens, self.llm_name):
-            database_logger.error(
-                "Can't update token usage for {}/CHAT".format(self.tenant_id))
+        USAGE.add(self.tenant_id, self.llm_type, used_tokens, self.llm_name)
         return txt
 
     def chat_streamly(self, system, history, gen_conf):
         for txt in self.mdl.chat_streamly(system, history, gen_conf):
             if isinstance(txt, int):
-                if not TenantLLMService.increase_usage(
-                        self.tenant_id, self.llm_type, txt, self.llm_name):
-                    database_logger.error(
-                        "Can't update token usage for {}/CHAT".format(self.tenant_id))
+                USAGE.add(self.tenant_id, self.llm_type, txt, self.llm_name)
                 return
             yield txt
@@ -171,3 +171,4 @@ def queue_tasks(doc, bucket, name):
 
     for t in tsks:
         assert REDIS_CONN.queue_product(SVR_QUEUE_NAME, message=t), "Can't access Redis. Please check the Redis' status."
+    return tsks
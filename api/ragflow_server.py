@@ -26,6 +26,7 @@ from werkzeug.serving import run_simple
 from api.apps import app
 from api.db.runtime_config import RuntimeConfig
 from api.db.services.document_service import DocumentService
+from api.db.services.llm_service import USAGE
 from api.settings import (
     HOST, HTTP_PORT, access_logger, database_logger, stat_logger,
 )
@@ -88,6 +89,9 @@ if __name__ == '__main__':
     thr = ThreadPoolExecutor(max_workers=1)
     thr.submit(update_progress)
 
+    # exit through sys.exit so that atexit handlers, e.g. the token usage flush, run
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
     # start http server
     try:
         stat_logger.info("RAG Flow http server start...")
@@ -97,4 +101,5 @@ if __name__ == '__main__':
         run_simple(hostname=HOST, port=HTTP_PORT, application=app, threaded=True, use_reloader=RuntimeConfig.DEBUG, use_debugger=RuntimeConfig.DEBUG)
     except Exception:
         traceback.print_exc()
+        USAGE.flush()
         os.kill(os.getpid(), signal.SIGKILL)
\ No newline at end of file
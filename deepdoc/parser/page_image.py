@@ -0,0 +1,138 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Page images rasterized on demand, so that parsing a PDF does not hold every
+page of it as a full-resolution image.
+
+PdfRasterizer keeps the PDF open in pdfium and at most PDF_PAGE_CACHE
+rendered pages in memory; an evicted page is rendered again when it is asked
+for, which gives the very same pixels. LazyPageImage stands in for the
+PIL image of one page: its size is known without rendering, crop() renders
+only the asked region when the page is not in memory, and anything else
+(np.array(), save(), ...) goes to the full page image.
+"""
+import math
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+import numpy as np
+import pypdfium2
+from PIL import Image
+
+PDF_PAGE_STREAMING = int(os.environ.get("PDF_PAGE_STREAMING", 1)) > 0
+# rendered pages kept in memory per document
+PDF_PAGE_CACHE = int(os.environ.get("PDF_PAGE_CACHE", 4))
+
+
+class PdfRasterizer:
+    def __init__(self, fnm, zoomin=3, cache_pages=PDF_PAGE_CACHE):
+        self.pdf = pypdfium2.PdfDocument(fnm if isinstance(fnm, str) else BytesIO(fnm))
+        self.scale = zoomin
+        self.cache_pages = max(1, cache_pages)
+        self.cache = OrderedDict()
+        # pdfium is not thread safe
+        self.lock = threading.Lock()
+        self.renders = 0
+        self.region_renders = 0
+
+    def __len__(self):
+        return len(self.pdf)
+
+    def size(self, pn):
+        # the same rounding pypdfium2 renders a page with
+        with self.lock:
+            page = self.pdf[pn]
+            return math.ceil(page.get_width() * self.scale), math.ceil(page.get_height() * self.scale)
+
+    def _render(self, pn, crop=(0, 0, 0, 0)):
+        # the same arguments pdfplumber's Page.to_image() renders with
+        page = self.pdf[pn]
+        return page.render(scale=self.scale, crop=crop,
+                           no_smoothtext=True, no_smoothpath=True, no_smoothimage=True,
+                           prefer_bgrx=True).to_pil().convert("RGB")
+
+    def image(self, pn):
+        with self.lock:
+            if pn in self.cache:
+                self.cache.move_to_end(pn)
+                return self.cache[pn]
+            img = self._render(pn)
+            self.renders += 1
+            self.cache[pn] = img
+            while len(self.cache) > self.cache_pages:
+                self.cache.popitem(last=False)
+            return img
+
+    def crop(self, pn, box):
+        """ Image.crop() of the page image, rendering only that region when the page is not in memory. """
+        with self.lock:
+            img = self.cache.get(pn)
+        if img is not None:
+            return img.crop(box)
+
+        left, top, right, bott = [int(round(b)) for b in box]
+        width, height = self.size(pn)
+        l, t, r, b = max(0, left), max(0, top), min(width, right), min(height, bott)
+        if r <= l or b <= t:
+            return self.image(pn).crop(box)
+        with self.lock:
+            # pypdfium2 rounds the crop up to whole pixels
+            region = self._render(pn, crop=tuple((c - .5) / self.scale for c in
+                                                 [l, height - b, width - r, t]))
+            self.region_renders += 1
+        if region.size == (right - left, bott - top):
+            return region
+        # the asked box goes beyond the page, pad it the way Image.crop() does
+        res = Image.new("RGB", (right - left, bott - top))
+        res.paste(region, (l - left, t - top))
+        return res
+
+    def pages(self, page_from, page_to):
+        return [LazyPageImage(self, pn) for pn in range(page_from, min(page_to, len(self)))]
+
+    def stats(self):
+        return {"pages": len(self), "renders": self.renders,
+                "region_renders": self.region_renders, "cached": len(self.cache)}
+
+
+class LazyPageImage:
+    def __init__(self, rasterizer, pn):
+        self.rasterizer = rasterizer
+        self.pn = pn
+        self.size = rasterizer.size(pn)
+
+    def crop(self, box=None):
+        if box is None:
+            return self.rasterizer.image(self.pn).copy()
+        return self.rasterizer.crop(self.pn, box)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.rasterizer.image(self.pn), dtype=dtype)
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.rasterizer.image(self.pn), name)
+
+
+class LazyCrop:
+    """ A region of a page image, cropped only when its pixels are asked for. """
+    def __init__(self, img, box):
+        self.img = img
+        self.box = box
+        self.size = (int(round(box[2])) - int(round(box[0])), int(round(box[3])) - int(round(box[1])))
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.img.crop(self.box), dtype=dtype)
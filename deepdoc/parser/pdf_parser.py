@@ -13,6 +13,8 @@
 
 import os
 import random
+import multiprocessing
+import threading
 
 import xgboost as xgb
 from io import BytesIO
@@ -26,13 +28,62 @@ from timeit import default_timer as timer
 from PyPDF2 import PdfReader as pdf2_read
 
 from api.utils.file_utils import get_project_base_directory
-from deepdoc.vision import OCR, Recognizer, LayoutRecognizer, TableStructureRecognizer
+from deepdoc.vision import OCR, Recognizer, BoxIndex, LayoutRecognizer, TableStructureRecognizer, ort_session
+from deepdoc.parser.page_image import PdfRasterizer, LazyCrop, PDF_PAGE_STREAMING
 from rag.nlp import rag_tokenizer
 from copy import deepcopy
 from huggingface_hub import snapshot_download
 
 logging.getLogger("pdfminer").setLevel(logging.WARNING)
 
+# Pages whose text layer can be trusted get their text boxes from it, OCR only
+# runs over the images on them.
+PDF_TEXT_LAYER = int(os.environ.get("PDF_TEXT_LAYER", 1)) > 0
+# fewer glyphs than this and the page is OCRed
+PDF_TEXT_LAYER_MIN_CHARS = int(os.environ.get("PDF_TEXT_LAYER_MIN_CHARS", 32))
+
+# Upper bound of the OCR worker processes a parser_config may ask for, each
+# of them loads its own OCR models.
+OCR_MAX_WORKERS = int(os.environ.get("OCR_MAX_WORKERS", os.cpu_count() or 1))
+
+# The process pool for page-parallel OCR, grown to the largest worker count
+# asked so far and shared by every parser. Each worker process holds its own
+# OCR (ONNX sessions), built once in the initializer.
+_OCR_POOL = None
+_OCR_POOL_SIZE = 0
+_OCR_POOL_LOCK = threading.Lock()
+_worker_ocr = None
+
+
+def _init_ocr_worker(workers):
+    global _worker_ocr
+    # the workers share the cores, rather than each of them starting a thread per core
+    if not ort_session.ONNX_INTRA_OP_THREADS:
+        ort_session.ONNX_INTRA_OP_THREADS = max(1, (os.cpu_count() or 1) // max(1, workers))
+    _worker_ocr = OCR()
+
+
+def _ocr_pages_worker(args):
+    return RAGFlowPdfParser._ocr_pages(_worker_ocr, *args)
+
+
+def ocr_workers(workers):
+    return max(0, min(int(workers), OCR_MAX_WORKERS))
+
+
+def _ocr_pool(workers):
+    global _OCR_POOL, _OCR_POOL_SIZE
+    workers = ocr_workers(workers)
+    with _OCR_POOL_LOCK:
+        if _OCR_POOL is None or _OCR_POOL_SIZE < workers:
+            if _OCR_POOL is not None:
+                # jobs already handed to it still finish
+                _OCR_POOL.close()
+            _OCR_POOL = multiprocessing.get_context("spawn").Pool(
+                workers, initializer=_init_ocr_worker, initargs=(workers,))
+            _OCR_POOL_SIZE = workers
+        return _OCR_POOL
+
 
 class RAGFlowPdfParser:
     def __init__(self):
@@ -61,6 +112,11 @@ class RAGFlowPdfParser:
                 model_dir, "updown_concat_xgb.model"))
 
         self.page_from = 0
+        # Number of processes used to OCR pages in parallel, <= 1 to OCR in place,
+        # at most OCR_MAX_WORKERS.
+        self.ocr_workers = 0
+        # Number of pages whose text detection and recognition are batched together.
+        self.ocr_batch_size = 4
         """
         If you have trouble downloading HuggingFace models, -_^ this might help!!
 
@@ -181,6 +237,70 @@ class RAGFlowPdfParser:
                     return False
         return True
 
+    def _text_layer_regions(self, page, chars):
+        """
+        Whether the text layer of a page can stand in for OCR: enough glyphs,
+        nearly all of them decoding to upright text, and less than half of
+        the page covered by images. Returns the image regions on the page
+        still to be OCRed, or None if the whole page is.
+        """
+        glyphs = [c for c in chars if c["text"].strip()]
+        if len(glyphs) < PDF_TEXT_LAYER_MIN_CHARS:
+            return None
+        bad = [c for c in glyphs if not c.get("upright", True)
+               or re.search(r"\(cid:[0-9]+\)|[\x00-\x1f\ufffd\ue000-\uf8ff]", c["text"])]
+        if len(bad) > len(glyphs) * 0.05:
+            return None
+
+        regions = []
+        for im in page.images:
+            x0, top = max(0, float(im["x0"])), max(0, float(im["top"]))
+            x1, bott = min(float(page.width), float(im["x1"])), min(float(page.height), float(im["bottom"]))
+            if x1 - x0 >= 16 and bott - top >= 16:
+                regions.append((x0, top, x1, bott))
+        if sum([(r[2] - r[0]) * (r[3] - r[1]) for r in regions]) > page.width * page.height / 2:
+            return None
+        return regions
+
+    @staticmethod
+    def _text_layer_boxes(chars, pagenum):
+        """
+        Text lines of a page built from its chars, the boxes OCR would have given:
+        chars are grouped into lines by their vertical middle, and a line is cut
+        where the gap to the next char is wider than the line is high.
+        """
+        lines = []
+        for c in sorted([c for c in chars if c["text"]], key=lambda c: (c["top"] + c["bottom"]) / 2):
+            mid = (c["top"] + c["bottom"]) / 2
+            if lines and abs(mid - lines[-1][0]) <= (c["bottom"] - c["top"]) / 2:
+                lines[-1][1].append(c)
+            else:
+                lines.append([mid, [c]])
+
+        bxs = []
+        for _, line in lines:
+            line = sorted(line, key=lambda c: c["x0"])
+            height = max([c["bottom"] - c["top"] for c in line])
+            b, prev, space = None, None, False
+            for c in line:
+                if not c["text"].strip():
+                    space = True
+                    continue
+                if b is None or c["x0"] - prev["x1"] > height:
+                    b = {"x0": c["x0"], "x1": c["x1"], "top": c["top"], "bottom": c["bottom"],
+                         "text": c["text"], "page_number": pagenum}
+                    bxs.append(b)
+                else:
+                    if (space or c["x0"] - prev["x1"] >= min(c["width"], prev["width"]) / 2) \
+                            and re.match(r"[0-9a-zA-Z,.:;!%]+", prev["text"] + c["text"]):
+                        b["text"] += " "
+                    b["text"] += c["text"]
+                    b["x1"] = max(b["x1"], c["x1"])
+                    b["top"] = min(b["top"], c["top"])
+                    b["bottom"] = max(b["bottom"], c["bottom"])
+                prev, space = c, False
+        return bxs
+
     def _table_transformer_job(self, ZM):
         logging.info("Table processing...")
         imgs, pos = [], []
@@ -240,17 +360,17 @@ class RAGFlowPdfParser:
         clmns = sorted([r for r in self.tb_cpns if re.match(
             r"table column$", r["label"])], key=lambda x: (x["pn"], x["layoutno"], x["x0"]))
         clmns = Recognizer.layouts_cleanup(self.boxes, clmns, 5, 0.5)
+        rows_idx, headers_idx, spans_idx = BoxIndex(rows), BoxIndex(headers), BoxIndex(spans)
         for b in self.boxes:
             if b.get("layout_type", "") != "table":
                 continue
-            ii = Recognizer.find_overlapped_with_threashold(b, rows, thr=0.3)
+            ii = rows_idx.find_overlapped_with_threashold(b, thr=0.3)
             if ii is not None:
                 b["R"] = ii
                 b["R_top"] = rows[ii]["top"]
                 b["R_bott"] = rows[ii]["bottom"]
 
-            ii = Recognizer.find_overlapped_with_threashold(
-                b, headers, thr=0.3)
+            ii = headers_idx.find_overlapped_with_threashold(b, thr=0.3)
             if ii is not None:
                 b["H_top"] = headers[ii]["top"]
                 b["H_bott"] = headers[ii]["bottom"]
@@ -264,7 +384,7 @@ class RAGFlowPdfParser:
                 b["C_left"] = clmns[ii]["x0"]
                 b["C_right"] = clmns[ii]["x1"]
 
-            ii = Recognizer.find_overlapped_with_threashold(b, spans, thr=0.3)
+            ii = spans_idx.find_overlapped_with_threashold(b, thr=0.3)
             if ii is not None:
                 b["H_top"] = spans[ii]["top"]
                 b["H_bott"] = spans[ii]["bottom"]
@@ -272,51 +392,95 @@ class RAGFlowPdfParser:
                 b["H_right"] = spans[ii]["x1"]
                 b["SP"] = ii
 
-    def __ocr(self, pagenum, img, chars, ZM=3):
-        bxs = self.ocr.detect(np.array(img))
-        if not bxs:
-            self.boxes.append([])
-            return
-        bxs = [(line[0], line[1][0]) for line in bxs]
-        bxs = Recognizer.sort_Y_firstly(
-            [{"x0": b[0][0] / ZM, "x1": b[1][0] / ZM,
-              "top": b[0][1] / ZM, "text": "", "txt": t,
-              "bottom": b[-1][1] / ZM,
-              "page_number": pagenum} for b, t in bxs if b[0][0] <= b[1][0] and b[0][1] <= b[-1][1]],
-            self.mean_height[-1] / 3
-        )
-
-        # merge chars in the same rect
-        for c in Recognizer.sort_X_firstly(
-                chars, self.mean_width[pagenum - 1] // 4):
-            ii = Recognizer.find_overlapped(c, bxs)
-            if ii is None:
-                self.lefted_chars.append(c)
-                continue
-            ch = c["bottom"] - c["top"]
-            bh = bxs[ii]["bottom"] - bxs[ii]["top"]
-            if abs(ch - bh) / max(ch, bh) >= 0.7 and c["text"] != ' ':
-                self.lefted_chars.append(c)
+    @staticmethod
+    def _ocr_pages(ocr, pages, ZM=3):
+        """
+        OCR a batch of pages, each given as (pagenum, img, chars, mean_height, mean_width).
+        Text detection runs over all the pages in one call, then the boxes chars
+        could not fill are recognized together across the pages.
+        Returns, per page, the text boxes, the chars that did not fall into
+        any box and the (possibly re-estimated) mean height.
+        """
+        imgs = [np.array(img) for _, img, _, _, _ in pages]
+        res = []
+        to_rec = []
+        for pi, bxs in enumerate(ocr.detect_batch(imgs)):
+            pagenum, _, chars, mean_height, mean_width = pages[pi]
+            lefted_chars = []
+            res.append([[], lefted_chars, mean_height])
+            if not bxs:
                 continue
-            if c["text"] == " " and bxs[ii]["text"]:
-                if re.match(r"[0-9a-zA-Z,.?;:!%%]", bxs[ii]["text"][-1]):
-                    bxs[ii]["text"] += " "
-            else:
-                bxs[ii]["text"] += c["text"]
-
-        for b in bxs:
-            if not b["text"]:
-                left, right, top, bott = b["x0"] * ZM, b["x1"] * \
-                                         ZM, b["top"] * ZM, b["bottom"] * ZM
-                b["text"] = self.ocr.recognize(np.array(img),
-                                               np.array([[left, top], [right, top], [right, bott], [left, bott]],
-                                                        dtype=np.float32))
-            del b["txt"]
-        bxs = [b for b in bxs if b["text"]]
-        if self.mean_height[-1] == 0:
-            self.mean_height[-1] = np.median([b["bottom"] - b["top"]
-                                              for b in bxs])
-        self.boxes.append(bxs)
+            bxs = [(line[0], line[1][0]) for line in bxs]
+            bxs = Recognizer.sort_Y_firstly(
+                [{"x0": b[0][0] / ZM, "x1": b[1][0] / ZM,
+                  "top": b[0][1] / ZM, "text": "", "txt": t,
+                  "bottom": b[-1][1] / ZM,
+                  "page_number": pagenum} for b, t in bxs if b[0][0] <= b[1][0] and b[0][1] <= b[-1][1]],
+                mean_height / 3
+            )
+
+            # merge chars in the same rect
+            index = BoxIndex(bxs)
+            for c in Recognizer.sort_X_firstly(
+                    chars, mean_width // 4):
+                ii = index.find_overlapped(c)
+                if ii is None:
+                    lefted_chars.append(c)
+                    continue
+                ch = c["bottom"] - c["top"]
+                bh = bxs[ii]["bottom"] - bxs[ii]["top"]
+                if abs(ch - bh) / max(ch, bh) >= 0.7 and c["text"] != ' ':
+                    lefted_chars.append(c)
+                    continue
+                if c["text"] == " " and bxs[ii]["text"]:
+                    if re.match(r"[0-9a-zA-Z,.?;:!%%]", bxs[ii]["text"][-1]):
+                        bxs[ii]["text"] += " "
+                else:
+                    bxs[ii]["text"] += c["text"]
+
+            for b in bxs:
+                if not b["text"]:
+                    left, right, top, bott = b["x0"] * ZM, b["x1"] * \
+                                             ZM, b["top"] * ZM, b["bottom"] * ZM
+                    to_rec.append((b, imgs[pi],
+                                   np.array([[left, top], [right, top], [right, bott], [left, bott]],
+                                            dtype=np.float32)))
+                del b["txt"]
+            res[-1][0] = bxs
+
+        for (b, _, _), txt in zip(to_rec, ocr.recognize_batch([(img, box) for _, img, box in to_rec])):
+            b["text"] = txt
+
+        for r in res:
+            r[0] = [b for b in r[0] if b["text"]]
+            if r[0] and r[2] == 0:
+                r[2] = np.median([b["bottom"] - b["top"]
+                                  for b in r[0]])
+        return [tuple(r) for r in res]
+
+    def _parallel_ocr(self, pages, ZM):
+        """
+        Shard pages across the OCR process pool, results are yielded in page order.
+        """
+        def _picklable(c):
+            return {k: v for k, v in c.items() if isinstance(v, (str, int, float, bool))}
+
+        def _shard(pages):
+            return [(pn, np.array(img), [_picklable(c) for c in chars], mh, mw)
+                    for pn, img, chars, mh, mw in pages], ZM
+
+        bs = max(1, self.ocr_batch_size)
+        shards = [pages[i: i + bs] for i in range(0, len(pages), bs)]
+        # hand the pool a few shards at a time, so that only their page images are in memory
+        win = max(1, ocr_workers(self.ocr_workers)) * 2
+        for w in range(0, len(shards), win):
+            for r in _ocr_pool(self.ocr_workers).imap(_ocr_pages_worker, [_shard(s) for s in shards[w: w + win]]):
+                yield from r
+
+    def _serial_ocr(self, pages, ZM):
+        bs = max(1, self.ocr_batch_size)
+        for i in range(0, len(pages), bs):
+            yield from self._ocr_pages(self.ocr, pages[i: i + bs], ZM)
 
     def _layouts_rec(self, ZM, drop=True):
         assert len(self.page_images) == len(self.boxes)
@@ -942,6 +1106,7 @@ class RAGFlowPdfParser:
         self.mean_height = []
         self.mean_width = []
         self.boxes = []
+        self.page_text_layers = []
         self.garbages = {}
         self.page_cum_height = [0]
         self.page_layout = []
@@ -950,10 +1115,21 @@ class RAGFlowPdfParser:
         try:
             self.pdf = pdfplumber.open(fnm) if isinstance(
                 fnm, str) else pdfplumber.open(BytesIO(fnm))
-            self.page_images = [p.to_image(resolution=72 * zoomin).annotated for i, p in
-                                enumerate(self.pdf.pages[page_from:page_to])]
-            self.page_chars = [[{**c, 'top': max(0, c['top'] - 10), 'bottom': max(0, c['bottom'] - 10)} for c in page.chars if self._has_color(c)] for page in
-                               self.pdf.pages[page_from:page_to]]
+            if PDF_PAGE_STREAMING:
+                # pages are rendered when they are used, only a few of them stay in memory
+                self.rasterizer = PdfRasterizer(fnm, zoomin)
+                self.page_images = self.rasterizer.pages(page_from, page_to)
+            else:
+                self.page_images = [p.to_image(resolution=72 * zoomin).annotated for i, p in
+                                    enumerate(self.pdf.pages[page_from:page_to])]
+            self.page_chars = []
+            self.page_text_layers = []
+            for i, page in enumerate(self.pdf.pages[page_from:page_to]):
+                chars = [c for c in page.chars if self._has_color(c)]
+                self.page_chars.append([{**c, 'top': max(0, c['top'] - 10), 'bottom': max(0, c['bottom'] - 10)} for c in chars])
+                regions = self._text_layer_regions(page, chars) if PDF_TEXT_LAYER else None
+                self.page_text_layers.append(None if regions is None else
+                                             (self._text_layer_boxes(chars, i + 1), regions))
             self.total_page = len(self.pdf.pages)
         except Exception as e:
             logging.error(str(e))
@@ -988,6 +1164,7 @@ class RAGFlowPdfParser:
         self.is_english = False
 
         st = timer()
+        pages = []
         for i, img in enumerate(self.page_images):
             chars = self.page_chars[i] if not self.is_english else []
             self.mean_height.append(
@@ -1005,10 +1182,46 @@ class RAGFlowPdfParser:
                                                                        chars[j]["width"]) / 2:
                     chars[j]["text"] += " "
                 j += 1
+            pages.append((i + 1, img, chars, self.mean_height[i], self.mean_width[i]))
+
+        # 有可信文字层的页面直接用文字层，只对其中的图片做OCR
+        jobs, ocr_pages = [], []
+        for i, page in enumerate(pages):
+            layer = self.page_text_layers[i] if i < len(self.page_text_layers) else None
+            if layer is None:
+                self.boxes.append([])
+                jobs.append((i, None))
+                ocr_pages.append(page)
+                continue
+            self.boxes.append(layer[0])
+            for region in layer[1]:
+                jobs.append((i, region))
+                ocr_pages.append((page[0], LazyCrop(page[1], [x * zoomin for x in region]), [], page[3], page[4]))
 
-            self.__ocr(i + 1, img, chars, zoomin)
-            if callback and i % 6 == 5:
-                callback(prog=(i + 1) * 0.6 / len(self.page_images), msg="")
+        if ocr_workers(self.ocr_workers) > 1 and len(ocr_pages) > 1:
+            results = self._parallel_ocr(ocr_pages, zoomin)
+        else:
+            results = self._serial_ocr(ocr_pages, zoomin)
+        for j, ((i, region), (bxs, lefted_chars, mean_height)) in enumerate(zip(jobs, results)):
+            if region is None:
+                self.boxes[i] = bxs
+                self.lefted_chars.extend(lefted_chars)
+                self.mean_height[i] = mean_height
+            else:
+                for b in bxs:
+                    b["x0"] += region[0]
+                    b["x1"] += region[0]
+                    b["top"] += region[1]
+                    b["bottom"] += region[1]
+                # text drawn over an image is in the text layer already
+                self.boxes[i].extend([b for b in bxs if Recognizer.find_overlapped(b, self.boxes[i], naive=True) is None])
+            if callback and j % 6 == 5:
+                callback(prog=(j + 1) * 0.6 / len(jobs), msg="")
+        for i, page in enumerate(pages):
+            if i < len(self.page_text_layers) and self.page_text_layers[i] is not None:
+                self.boxes[i] = Recognizer.sort_Y_firstly(self.boxes[i], self.mean_height[i] / 3)
+        logging.info("Text layer used for {}/{} pages".format(
+            len([l for l in self.page_text_layers if l is not None]), len(pages)))
         # print("OCR:", timer()-st)
 
         if not self.is_english and not any(
@@ -14,7 +14,7 @@
 import pdfplumber
 
 from .ocr import OCR
-from .recognizer import Recognizer
+from .recognizer import Recognizer, BoxIndex
 from .layout_recognizer import LayoutRecognizer
 from .table_structure_recognizer import TableStructureRecognizer
 
@@ -20,9 +20,9 @@ from huggingface_hub import snapshot_download
 from api.utils.file_utils import get_project_base_directory
 from .operators import *
 import numpy as np
-import onnxruntime as ort
 
 from .postprocess import build_post_process
+from .ort_session import get_session
 from rag.settings import cron_logger
 
 
@@ -65,21 +65,7 @@ def load_model(model_dir, nm):
         raise ValueError("not find model file path {}".format(
             model_file_path))
 
-    options = ort.SessionOptions()
-    options.enable_cpu_mem_arena = False
-    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
-    options.intra_op_num_threads = 2
-    options.inter_op_num_threads = 2
-    if False and ort.get_device() == "GPU":
-        sess = ort.InferenceSession(
-            model_file_path,
-            options=options,
-            providers=['CUDAExecutionProvider'])
-    else:
-        sess = ort.InferenceSession(
-            model_file_path,
-            options=options,
-            providers=['CPUExecutionProvider'])
+    sess = get_session(model_file_path)
     return sess, sess.get_inputs()[0]
 
 
@@ -379,6 +365,7 @@ class TextDetector(object):
 
         self.postprocess_op = build_post_process(postprocess_params)
         self.predictor, self.input_tensor = load_model(model_dir, 'det')
+        self.det_batch_num = 8
 
         img_h, img_w = self.input_tensor.shape[2:]
         if isinstance(img_h, str) or isinstance(img_w, str):
@@ -464,6 +451,42 @@ class TextDetector(object):
 
         return dt_boxes, time.time() - st
 
+    def batch(self, img_list):
+        """
+        Detect text on several images. Images whose preprocessed tensors have
+        the same shape (pages of one PDF mostly do) are stacked and run
+        through the model together, det_batch_num at a time.
+        """
+        st = time.time()
+        dt_boxes = [None] * len(img_list)
+        groups = {}
+        for i, img in enumerate(img_list):
+            data = transform({'image': img}, self.preprocess_op)
+            if data is None or data[0] is None:
+                continue
+            groups.setdefault(data[0].shape, []).append((i, data[0], data[1]))
+
+        for grp in groups.values():
+            for b in range(0, len(grp), self.det_batch_num):
+                bt = grp[b: b + self.det_batch_num]
+                input_dict = {}
+                input_dict[self.input_tensor.name] = np.stack([im for _, im, _ in bt])
+                for i in range(100000):
+                    try:
+                        outputs = self.predictor.run(None, input_dict)
+                        break
+                    except Exception as e:
+                        if i >= 3:
+                            raise e
+                        time.sleep(5)
+
+                post_result = self.postprocess_op({"maps": outputs[0]},
+                                                  np.stack([shp for _, _, shp in bt]))
+                for (i, _, _), r in zip(bt, post_result):
+                    dt_boxes[i] = self.filter_tag_det_res(r['points'], img_list[i].shape)
+
+        return dt_boxes, time.time() - st
+
 
 class OCR(object):
     def __init__(self, model_dir=None):
@@ -573,6 +596,22 @@ class OCR(object):
         return zip(self.sorted_boxes(dt_boxes), [
                    ("", 0) for _ in range(len(dt_boxes))])
 
+    def detect_batch(self, img_list):
+        """
+        Batched version of detect(). Returns, for every image, the sorted
+        text boxes in the same form as detect() or None if nothing was found.
+        """
+        dt_boxes_list, elapse = self.text_detector.batch(img_list)
+        cron_logger.debug("det images num : {}, elapsed : {}".format(
+            len(img_list), elapse))
+        res = []
+        for dt_boxes in dt_boxes_list:
+            if dt_boxes is None:
+                res.append(None)
+                continue
+            res.append([(b, ("", 0)) for b in self.sorted_boxes(dt_boxes)])
+        return res
+
     def recognize(self, ori_im, box):
         img_crop = self.get_rotate_crop_image(ori_im, box)
 
@@ -582,6 +621,20 @@ class OCR(object):
             return ""
         return text
 
+    def recognize_batch(self, img_box_list):
+        """
+        Recognize the text of many (image, box) pairs at once. The crops may
+        come from different images; TextRecognizer sorts them by width and
+        runs them in padded mini-batches.
+        """
+        if not img_box_list:
+            return []
+        img_crop_list = [self.get_rotate_crop_image(ori_im, box) for ori_im, box in img_box_list]
+        rec_res, elapse = self.text_recognizer(img_crop_list)
+        cron_logger.debug("rec_res num  : {}, elapsed : {}".format(
+            len(rec_res), elapse))
+        return [text if score >= self.drop_score else "" for text, score in rec_res]
+
     def __call__(self, img, cls=True):
         time_dict = {'det': 0, 'rec': 0, 'cls': 0, 'all': 0}
 
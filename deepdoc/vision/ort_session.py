@@ -0,0 +1,99 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os
+import threading
+from timeit import default_timer as timer
+
+import onnxruntime as ort
+
+from rag.settings import cron_logger
+
+# 0: onnxruntime's default, one thread per physical core
+ONNX_INTRA_OP_THREADS = int(os.environ.get("ONNX_INTRA_OP_THREADS", 0))
+ONNX_INTER_OP_THREADS = int(os.environ.get("ONNX_INTER_OP_THREADS", 0))
+# disable, basic, extended or all
+ONNX_GRAPH_OPT_LEVEL = os.environ.get("ONNX_GRAPH_OPT_LEVEL", "all").lower()
+ONNX_MEM_ARENA = int(os.environ.get("ONNX_MEM_ARENA", 1)) > 0
+ONNX_PARALLEL = int(os.environ.get("ONNX_PARALLEL", 0)) > 0
+
+GRAPH_OPT_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+
+def session_options():
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = ONNX_INTRA_OP_THREADS
+    options.inter_op_num_threads = ONNX_INTER_OP_THREADS
+    options.graph_optimization_level = GRAPH_OPT_LEVELS.get(ONNX_GRAPH_OPT_LEVEL,
+                                                            ort.GraphOptimizationLevel.ORT_ENABLE_ALL)
+    options.enable_cpu_mem_arena = ONNX_MEM_ARENA
+    options.execution_mode = ort.ExecutionMode.ORT_PARALLEL if ONNX_PARALLEL else ort.ExecutionMode.ORT_SEQUENTIAL
+    return options
+
+
+class TimedSession:
+    """ An InferenceSession which keeps count of its runs and their latency. """
+    def __init__(self, model_file_path):
+        self.model_file_path = model_file_path
+        st = timer()
+        self.sess = ort.InferenceSession(model_file_path, sess_options=session_options(),
+                                         providers=['CPUExecutionProvider'])
+        self.load_time = timer() - st
+        self.lock = threading.Lock()
+        self.runs = 0
+        self.elapsed = 0.
+        self.max_elapsed = 0.
+        cron_logger.info("ONNX model {} loaded in {:.2f}s".format(os.path.basename(model_file_path), self.load_time))
+
+    def run(self, output_names, input_feed, run_options=None):
+        st = timer()
+        res = self.sess.run(output_names, input_feed, run_options)
+        el = timer() - st
+        with self.lock:
+            self.runs += 1
+            self.elapsed += el
+            self.max_elapsed = max(self.max_elapsed, el)
+        return res
+
+    def __getattr__(self, name):
+        return getattr(self.sess, name)
+
+    def stats(self):
+        with self.lock:
+            return {"load_time": self.load_time, "runs": self.runs,
+                    "avg_latency": self.elapsed / self.runs if self.runs else 0.,
+                    "max_latency": self.max_elapsed}
+
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+def get_session(model_file_path):
+    """ The process wide session of an ONNX model, loaded the first time it is asked for. """
+    model_file_path = os.path.realpath(model_file_path)
+    with _lock:
+        if model_file_path not in _sessions:
+            _sessions[model_file_path] = TimedSession(model_file_path)
+        return _sessions[model_file_path]
+
+
+def stats():
+    with _lock:
+        sessions = list(_sessions.items())
+    return {os.path.basename(p): s.stats() for p, s in sessions}
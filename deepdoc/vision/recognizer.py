@@ -12,16 +12,110 @@
 #
 
 import os
-from copy import deepcopy
 
-import onnxruntime as ort
 from huggingface_hub import snapshot_download
 
 from api.utils.file_utils import get_project_base_directory
 from .operators import *
+from .ort_session import get_session
 from rag.settings import cron_logger
 
 
+def overlapped_areas(a, b, ratio=True):
+    """
+    Recognizer.overlapped_area over arrays: a and b are (x0, x1, top, bottom),
+    each either a number or an array, and a is the box the ratio is taken of.
+    """
+    ax0, ax1, atp, abtm = a
+    bx0, bx1, btp, bbtm = b
+    hit = ~((bx0 > ax1) | (bx1 < ax0) | (bbtm < atp) | (btp > abtm))
+    w, h = ax1 - ax0, abtm - atp
+    ov = (np.minimum(bbtm, abtm) - np.maximum(btp, atp)) * (np.minimum(bx1, ax1) - np.maximum(bx0, ax0))
+    ov = np.where(hit & (w != 0) & (h != 0), ov, 0.)
+    if ratio:
+        area = w * h
+        ov = np.where(ov > 0, ov / np.where(area != 0, area, 1), ov)
+    return ov
+
+
+class BoxIndex(object):
+    """
+    The coordinates of a list of boxes held as arrays, to look up the boxes
+    overlapping another one without a Python loop over them. The answers are
+    the ones of the Recognizer.find_overlapped* functions over the same list.
+    The list must not be reordered nor have its boxes moved while indexed.
+    """
+    def __init__(self, boxes):
+        self.boxes = boxes
+        self.x0, self.x1, self.top, self.bottom = [np.array([b[k] for b in boxes], dtype=float)
+                                                   for k in ["x0", "x1", "top", "bottom"]]
+        # y interval index: boxes by top, with the largest bottom so far
+        self.by_top = np.argsort(self.top, kind="stable")
+        self.sorted_top = self.top[self.by_top]
+        self.max_bottom = np.maximum.accumulate(self.bottom[self.by_top]) if len(boxes) else self.bottom
+
+    def __len__(self):
+        return len(self.boxes)
+
+    @staticmethod
+    def coords(box):
+        return box["x0"], box["x1"], box["top"], box["bottom"]
+
+    def _y_overlapped(self, box):
+        # boxes whose [top, bottom] meets the box's, in list order
+        e = int(np.searchsorted(self.sorted_top, box["bottom"], side="right"))
+        s = int(np.searchsorted(self.max_bottom[:e], box["top"], side="left"))
+        ii = self.by_top[s:e]
+        return np.sort(ii[self.bottom[ii] >= box["top"]])
+
+    def find_overlapped(self, box, naive=False):
+        n = len(self.boxes)
+        if not n:
+            return
+        top, bottom = self.top, self.bottom
+        s, e, ii = 0, n, 0
+        while s < e and not naive:
+            ii = (e + s) // 2
+            if box["bottom"] < top[ii]:
+                e = ii
+                continue
+            if box["top"] > bottom[ii]:
+                s = ii + 1
+                continue
+            break
+        if s < ii and box["top"] > bottom[s]:
+            s += 1
+        if e - 1 > ii and box["bottom"] < top[e - 1]:
+            e -= 1
+        if s >= e:
+            return
+        ov = overlapped_areas((self.x0[s:e], self.x1[s:e], top[s:e], bottom[s:e]), self.coords(box))
+        i = int(np.argmax(ov))
+        return s + i if ov[i] > 0 else None
+
+    def find_overlapped_with_threashold(self, box, thr=0.3):
+        if not self.boxes:
+            return
+        # only boxes overlapping it can pass a positive threshold
+        ii = self._y_overlapped(box) if thr > 0 else np.arange(len(self.boxes))
+        if not len(ii):
+            return
+        arrs = (self.x0[ii], self.x1[ii], self.top[ii], self.bottom[ii])
+        ov = overlapped_areas(self.coords(box), arrs)
+        _ov = overlapped_areas(arrs, self.coords(box))
+        ok = ov >= thr
+        if not ok.any():
+            return
+        best = ok & (ov == ov[ok].max())
+        best &= _ov == _ov[best].max()
+        # the last one of the best, as the loop kept it
+        return int(ii[np.flatnonzero(best)[-1]])
+
+    def overlapped_area_sum(self, box):
+        # sum of Recognizer.overlapped_area(b, box, False) over the boxes, added up in order
+        return sum(overlapped_areas((self.x0, self.x1, self.top, self.bottom), self.coords(box), False).tolist())
+
+
 class Recognizer(object):
     def __init__(self, label_list, task_name, model_dir=None):
         """
@@ -51,85 +145,90 @@ class Recognizer(object):
         if not os.path.exists(model_file_path):
             raise ValueError("not find model file path {}".format(
                 model_file_path))
-        if False and ort.get_device() == "GPU":
-            options = ort.SessionOptions()
-            options.enable_cpu_mem_arena = False
-            self.ort_sess = ort.InferenceSession(model_file_path, options=options, providers=[('CUDAExecutionProvider')])
-        else:
-            self.ort_sess = ort.InferenceSession(model_file_path, providers=['CPUExecutionProvider'])
+        self.ort_sess = get_session(model_file_path)
         self.input_names = [node.name for node in self.ort_sess.get_inputs()]
         self.output_names = [node.name for node in self.ort_sess.get_outputs()]
         self.input_shape = self.ort_sess.get_inputs()[0].shape[2:4]
+        # a model exported with a fixed batch size of 1 takes one image per run
+        batch_dim = self.ort_sess.get_inputs()[0].shape[0]
+        self.batchable = not (isinstance(batch_dim, int) and batch_dim == 1)
         self.label_list = label_list
 
+    @staticmethod
+    def _threshold_sort(arr, first, second, threashold):
+        """
+        Sort by `first` then `second`, then swap neighbours whose `first` differ
+        by less than the threshold and whose `second` are out of order, pass after
+        pass, as the bubble passes this replaced did. A box never moves across a
+        gap of at least the threshold in `first`, so the passes are replayed on
+        the (mostly tiny) buckets between such gaps, over plain floats.
+        """
+        n = len(arr)
+        if n < 2:
+            return list(arr)
+        f = np.array([r[first] for r in arr], dtype=float)
+        s = np.array([r[second] for r in arr], dtype=float)
+        order = np.lexsort((s, f))
+        f, s, order = f[order].tolist(), s[order].tolist(), order.tolist()
+        cuts = (np.flatnonzero(~(np.diff(f) < threashold)) + 1).tolist()
+        for a, b in zip([0] + cuts, cuts + [n]):
+            if b - a < 2:
+                continue
+            fb, sb, ob = f[a:b], s[a:b], order[a:b]
+
+            def swap_pass(i):
+                swapped = False
+                for j in range(i, -1, -1):
+                    if abs(fb[j + 1] - fb[j]) < threashold and sb[j + 1] < sb[j]:
+                        fb[j], fb[j + 1] = fb[j + 1], fb[j]
+                        sb[j], sb[j + 1] = sb[j + 1], sb[j]
+                        ob[j], ob[j + 1] = ob[j + 1], ob[j]
+                        swapped = True
+                return swapped
+
+            for i in range(b - a - 1):
+                swap_pass(i)
+            # the passes over the boxes after this bucket still go through it
+            for _ in range(n - b):
+                if not swap_pass(b - a - 2):
+                    break
+            order[a:b] = ob
+        return [arr[i] for i in order]
+
     @staticmethod
     def sort_Y_firstly(arr, threashold):
         # sort using y1 first and then x1
-        arr = sorted(arr, key=lambda r: (r["top"], r["x0"]))
-        for i in range(len(arr) - 1):
-            for j in range(i, -1, -1):
-                # restore the order using th
-                if abs(arr[j + 1]["top"] - arr[j]["top"]) < threashold \
-                        and arr[j + 1]["x0"] < arr[j]["x0"]:
-                    tmp = deepcopy(arr[j])
-                    arr[j] = deepcopy(arr[j + 1])
-                    arr[j + 1] = deepcopy(tmp)
-        return arr
+        return Recognizer._threshold_sort(arr, "top", "x0", threashold)
 
     @staticmethod
     def sort_X_firstly(arr, threashold, copy=True):
-        # sort using y1 first and then x1
-        arr = sorted(arr, key=lambda r: (r["x0"], r["top"]))
-        for i in range(len(arr) - 1):
-            for j in range(i, -1, -1):
-                # restore the order using th
-                if abs(arr[j + 1]["x0"] - arr[j]["x0"]) < threashold \
-                        and arr[j + 1]["top"] < arr[j]["top"]:
-                    tmp = deepcopy(arr[j]) if copy else arr[j]
-                    arr[j] = deepcopy(arr[j + 1]) if copy else arr[j + 1]
-                    arr[j + 1] = deepcopy(tmp) if copy else tmp
+        # sort using x1 first and then y1, boxes are not copied any more whatever `copy` is
+        return Recognizer._threshold_sort(arr, "x0", "top", threashold)
+
+    @staticmethod
+    def _sort_runs(arr, kwd, key):
+        # boxes without `kwd` stay where they are, each run of boxes having it is sorted by key
+        i = 0
+        while i < len(arr):
+            if kwd not in arr[i]:
+                i += 1
+                continue
+            j = i
+            while j < len(arr) and kwd in arr[j]:
+                j += 1
+            arr[i:j] = sorted(arr[i:j], key=key)
+            i = j
         return arr
 
     @staticmethod
     def sort_C_firstly(arr, thr=0):
-        # sort using y1 first and then x1
-        # sorted(arr, key=lambda r: (r["x0"], r["top"]))
         arr = Recognizer.sort_X_firstly(arr, thr)
-        for i in range(len(arr) - 1):
-            for j in range(i, -1, -1):
-                # restore the order using th
-                if "C" not in arr[j] or "C" not in arr[j + 1]:
-                    continue
-                if arr[j + 1]["C"] < arr[j]["C"] \
-                        or (
-                        arr[j + 1]["C"] == arr[j]["C"]
-                        and arr[j + 1]["top"] < arr[j]["top"]
-                ):
-                    tmp = arr[j]
-                    arr[j] = arr[j + 1]
-                    arr[j + 1] = tmp
-        return arr
-
-        return sorted(arr, key=lambda r: (r.get("C", r["x0"]), r["top"]))
+        return Recognizer._sort_runs(arr, "C", lambda r: (r["C"], r["top"]))
 
     @staticmethod
     def sort_R_firstly(arr, thr=0):
-        # sort using y1 first and then x1
-        # sorted(arr, key=lambda r: (r["top"], r["x0"]))
         arr = Recognizer.sort_Y_firstly(arr, thr)
-        for i in range(len(arr) - 1):
-            for j in range(i, -1, -1):
-                if "R" not in arr[j] or "R" not in arr[j + 1]:
-                    continue
-                if arr[j + 1]["R"] < arr[j]["R"] \
-                        or (
-                        arr[j + 1]["R"] == arr[j]["R"]
-                        and arr[j + 1]["x0"] < arr[j]["x0"]
-                ):
-                    tmp = arr[j]
-                    arr[j] = arr[j + 1]
-                    arr[j + 1] = tmp
-        return arr
+        return Recognizer._sort_runs(arr, "R", lambda r: (r["R"], r["x0"]))
 
     @staticmethod
     def overlapped_area(a, b, ratio=True):
@@ -161,6 +260,7 @@ class Recognizer(object):
                         a["top"] > b["bottom"]])
 
         i = 0
+        index = None
         while i + 1 < len(layouts):
             j = i + 1
             while j < min(i + far, len(layouts)) \
@@ -182,12 +282,10 @@ class Recognizer(object):
                     layouts.pop(i)
                 continue
 
-            area_i, area_i_1 = 0, 0
-            for b in boxes:
-                if not notOverlapped(b, layouts[i]):
-                    area_i += Recognizer.overlapped_area(b, layouts[i], False)
-                if not notOverlapped(b, layouts[j]):
-                    area_i_1 += Recognizer.overlapped_area(b, layouts[j], False)
+            if index is None:
+                index = BoxIndex(boxes)
+            area_i = index.overlapped_area_sum(layouts[i])
+            area_i_1 = index.overlapped_area_sum(layouts[j])
 
             if area_i > area_i_1:
                 layouts.pop(j)
@@ -427,24 +525,57 @@ class Recognizer(object):
             "score": float(scores[i])
         } for i in indices]
 
+    def run_batch(self, inputs):
+        """
+        Runs the session once for all the preprocessed images of `inputs`,
+        stacked into one NCHW tensor, zero padded to the largest of them.
+        Returns the first output of the model for each image.
+        """
+        def run_one(ins):
+            return self.ort_sess.run(None, {k: v for k, v in ins.items() if k in self.input_names})[0]
+
+        if len(inputs) < 2 or not self.batchable:
+            return [run_one(ins) for ins in inputs]
+
+        feed = {}
+        for k in [k for k in self.input_names if k in inputs[0]]:
+            arrs = [np.asarray(ins[k], dtype=np.float32) for ins in inputs]
+            if arrs[0].ndim == 4:
+                h, w = max([a.shape[2] for a in arrs]), max([a.shape[3] for a in arrs])
+                batch = np.zeros((len(arrs), arrs[0].shape[1], h, w), dtype=np.float32)
+                for j, a in enumerate(arrs):
+                    batch[j, :, :a.shape[2], :a.shape[3]] = a[0]
+                feed[k] = batch
+            else:
+                feed[k] = np.concatenate(arrs, axis=0)
+        try:
+            outs = self.ort_sess.run(None, feed)
+        except Exception as e:
+            cron_logger.warning("Batched inference not supported, one image per run from now on: " + str(e))
+            self.batchable = False
+            return [run_one(ins) for ins in inputs]
+
+        if "scale_factor" not in self.input_names:
+            return [outs[0][j: j + 1] for j in range(len(inputs))]
+        # 检测框是所有图片的拼在一起，第二个输出是每张图片的框数
+        nums = np.asarray(outs[1]).astype(int).reshape(-1) if len(outs) > 1 else []
+        if len(nums) != len(inputs) or nums.sum() != len(outs[0]):
+            self.batchable = False
+            return [run_one(ins) for ins in inputs]
+        return np.split(outs[0], np.cumsum(nums)[:-1])
+
     def __call__(self, image_list, thr=0.7, batch_size=16):
         res = []
-        imgs = []
-        for i in range(len(image_list)):
-            if not isinstance(image_list[i], np.ndarray):
-                imgs.append(np.array(image_list[i]))
-            else: imgs.append(image_list[i])
-
-        batch_loop_cnt = math.ceil(float(len(imgs)) / batch_size)
+        # 按批转换图片，页面图片可能是按需渲染的
+        batch_loop_cnt = math.ceil(float(len(image_list)) / batch_size)
         for i in range(batch_loop_cnt):
             start_index = i * batch_size
-            end_index = min((i + 1) * batch_size, len(imgs))
-            batch_image_list = imgs[start_index:end_index]
+            end_index = min((i + 1) * batch_size, len(image_list))
+            batch_image_list = [img if isinstance(img, np.ndarray) else np.array(img)
+                                for img in image_list[start_index:end_index]]
             inputs = self.preprocess(batch_image_list)
-            print("preprocess")
-            for ins in inputs:
-                bb = self.postprocess(self.ort_sess.run(None, {k:v for k,v in ins.items() if k in self.input_names})[0], ins, thr)
-                res.append(bb)
+            for ins, out in zip(inputs, self.run_batch(inputs)):
+                res.append(self.postprocess(out, ins, thr))
 
         #seeit.save_results(image_list, res, self.label_list, threshold=thr)
 
@@ -0,0 +1,168 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os
+import random
+import sys
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(
+                os.path.abspath(__file__)),
+            '../../')))
+
+from deepdoc.vision import Recognizer, BoxIndex
+from timeit import default_timer as timer
+import argparse
+
+
+def sort_Y_firstly(arr, threashold):
+    """ Recognizer.sort_Y_firstly before it was bucketed, without the copies. """
+    arr = sorted(arr, key=lambda r: (r["top"], r["x0"]))
+    for i in range(len(arr) - 1):
+        for j in range(i, -1, -1):
+            if abs(arr[j + 1]["top"] - arr[j]["top"]) < threashold \
+                    and arr[j + 1]["x0"] < arr[j]["x0"]:
+                arr[j], arr[j + 1] = arr[j + 1], arr[j]
+    return arr
+
+
+def sort_X_firstly(arr, threashold):
+    arr = sorted(arr, key=lambda r: (r["x0"], r["top"]))
+    for i in range(len(arr) - 1):
+        for j in range(i, -1, -1):
+            if abs(arr[j + 1]["x0"] - arr[j]["x0"]) < threashold \
+                    and arr[j + 1]["top"] < arr[j]["top"]:
+                arr[j], arr[j + 1] = arr[j + 1], arr[j]
+    return arr
+
+
+def sort_runs(arr, kwd, sec):
+    for i in range(len(arr) - 1):
+        for j in range(i, -1, -1):
+            if kwd not in arr[j] or kwd not in arr[j + 1]:
+                continue
+            if arr[j + 1][kwd] < arr[j][kwd] \
+                    or (arr[j + 1][kwd] == arr[j][kwd] and arr[j + 1][sec] < arr[j][sec]):
+                arr[j], arr[j + 1] = arr[j + 1], arr[j]
+    return arr
+
+
+def table_page(rows, cols, jitter, seed):
+    """ Cells of a dense table, a few of them tagged with row and column numbers. """
+    random.seed(seed)
+    boxes = []
+    for r in range(rows):
+        for c in range(cols):
+            top = r * 12 + random.uniform(-jitter, jitter)
+            x0 = c * 40 + random.uniform(-jitter, jitter)
+            b = {"top": top, "bottom": top + random.uniform(6, 11),
+                 "x0": x0, "x1": x0 + random.uniform(10, 38)}
+            if random.random() < 0.8:
+                b["R"], b["C"] = r, c
+            boxes.append(b)
+    random.shuffle(boxes)
+    return boxes
+
+
+def timed(f, *args):
+    st = timer()
+    res = f(*args)
+    return res, timer() - st
+
+
+def main(args):
+    boxes = table_page(args.rows, args.cols, args.jitter, args.seed)
+    ids = {id(b): i for i, b in enumerate(boxes)}
+
+    def same(a, b):
+        return [ids[id(x)] for x in a] == [ids[id(x)] for x in b]
+
+    print("boxes: {}".format(len(boxes)))
+    for name, old, new, thr in [
+        ("sort_Y_firstly", lambda: sort_Y_firstly(boxes, args.threshold),
+         lambda: Recognizer.sort_Y_firstly(boxes, args.threshold), args.threshold),
+        ("sort_X_firstly", lambda: sort_X_firstly(boxes, args.threshold),
+         lambda: Recognizer.sort_X_firstly(boxes, args.threshold, False), args.threshold),
+        ("sort_C_firstly", lambda: sort_runs(sort_X_firstly(boxes, args.threshold), "C", "top"),
+         lambda: Recognizer.sort_C_firstly(boxes, args.threshold), args.threshold),
+        ("sort_R_firstly", lambda: sort_runs(sort_Y_firstly(boxes, args.threshold), "R", "x0"),
+         lambda: Recognizer.sort_R_firstly(boxes, args.threshold), args.threshold),
+    ]:
+        a, el1 = timed(old)
+        b, el2 = timed(new)
+        print("{}: {:.3f}s -> {:.3f}s, x{:.1f}, same order: {}".format(name, el1, el2, el1 / el2, same(a, b)))
+
+    bxs = Recognizer.sort_Y_firstly(boxes, args.threshold)
+    queries = table_page(args.rows, args.cols, args.jitter * 2, args.seed + 1)
+    st = timer()
+    r1 = [Recognizer.find_overlapped(q, bxs) for q in queries]
+    r2 = [Recognizer.find_overlapped_with_threashold(q, bxs, 0.3) for q in queries]
+    el1 = timer() - st
+    st = timer()
+    index = BoxIndex(bxs)
+    r1_ = [index.find_overlapped(q) for q in queries]
+    r2_ = [index.find_overlapped_with_threashold(q, 0.3) for q in queries]
+    el2 = timer() - st
+    print("find_overlapped*: {:.3f}s -> {:.3f}s, x{:.1f}, same boxes: {}".format(
+        el1, el2, el1 / el2, r1 == r1_ and r2 == r2_))
+
+    layouts = Recognizer.sort_Y_firstly(table_page(args.rows // 4, args.cols // 2, args.jitter * 4, args.seed + 2), 0)
+    for l in layouts:
+        l["type"] = "table"
+    a, el1 = timed(layouts_cleanup, bxs, [dict(l) for l in layouts], 5, 0.1)
+    b, el2 = timed(Recognizer.layouts_cleanup, bxs, [dict(l) for l in layouts], 5, 0.1)
+    print("layouts_cleanup: {:.3f}s -> {:.3f}s, x{:.1f}, same layouts: {}".format(el1, el2, el1 / el2, a == b))
+
+
+def layouts_cleanup(boxes, layouts, far=2, thr=0.7):
+    """ Recognizer.layouts_cleanup summing the overlapped areas box by box. """
+    def notOverlapped(a, b):
+        return any([a["x1"] < b["x0"], a["x0"] > b["x1"], a["bottom"] < b["top"], a["top"] > b["bottom"]])
+
+    i = 0
+    while i + 1 < len(layouts):
+        j = i + 1
+        while j < min(i + far, len(layouts)) and notOverlapped(layouts[i], layouts[j]):
+            j += 1
+        if j >= min(i + far, len(layouts)):
+            i += 1
+            continue
+        if Recognizer.overlapped_area(layouts[i], layouts[j]) < thr \
+                and Recognizer.overlapped_area(layouts[j], layouts[i]) < thr:
+            i += 1
+            continue
+        area_i, area_i_1 = 0, 0
+        for b in boxes:
+            if not notOverlapped(b, layouts[i]):
+                area_i += Recognizer.overlapped_area(b, layouts[i], False)
+            if not notOverlapped(b, layouts[j]):
+                area_i_1 += Recognizer.overlapped_area(b, layouts[j], False)
+        if area_i > area_i_1:
+            layouts.pop(j)
+        else:
+            layouts.pop(i)
+    return layouts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', help="Table rows on the page. Default: 100", default=100, type=int)
+    parser.add_argument('--cols', help="Table columns on the page. Default: 25", default=25, type=int)
+    parser.add_argument('--jitter', help="Random shift of the cells, in points. Default: 2",
+                        default=2, type=float)
+    parser.add_argument('--threshold', help="Sorting threshold, in points. Default: 3", default=3, type=float)
+    parser.add_argument('--seed', help="Random seed. Default: 0", default=0, type=int)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,89 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os
+import sys
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(
+                os.path.abspath(__file__)),
+            '../../')))
+
+from deepdoc.vision import OCR, init_in_out
+from timeit import default_timer as timer
+import argparse
+import numpy as np
+
+
+def per_page(ocr, images):
+    """ The way RAGFlowPdfParser used to OCR: one page, then one box at a time. """
+    texts = []
+    for img in images:
+        img = np.array(img)
+        bxs = ocr.detect(img)
+        if not bxs:
+            continue
+        for b, _ in bxs:
+            texts.append(ocr.recognize(img, np.array(b, dtype=np.float32)))
+    return texts
+
+
+def batched(ocr, images, batch_size):
+    texts = []
+    for i in range(0, len(images), batch_size):
+        imgs = [np.array(img) for img in images[i: i + batch_size]]
+        img_box_list = []
+        for img, bxs in zip(imgs, ocr.detect_batch(imgs)):
+            if not bxs:
+                continue
+            img_box_list.extend([(img, np.array(b, dtype=np.float32)) for b, _ in bxs])
+        texts.extend(ocr.recognize_batch(img_box_list))
+    return texts
+
+
+def main(args):
+    ocr = OCR()
+    images, _ = init_in_out(args)
+    if not images:
+        print("No image found.")
+        return
+
+    # warm up the sessions
+    per_page(ocr, images[:1])
+
+    st = timer()
+    txt1 = per_page(ocr, images)
+    el1 = timer() - st
+    st = timer()
+    txt2 = batched(ocr, images, args.batch_size)
+    el2 = timer() - st
+
+    print("pages: {}, boxes: {}".format(len(images), len(txt1)))
+    print("per-page: {:.2f}s, {:.2f} pages/s".format(el1, len(images) / el1))
+    print("batched({}): {:.2f}s, {:.2f} pages/s".format(args.batch_size, el2, len(images) / el2))
+    print("same text: {}/{}".format(sum([1 for a, b in zip(txt1, txt2) if a == b]), len(txt1)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--inputs',
+                        help="Directory where to store images or PDFs, or a file path to a single image or PDF",
+                        required=True)
+    parser.add_argument('--output_dir', help="Directory where to store the output images. Default: './ocr_outputs'",
+                        default="./ocr_outputs")
+    parser.add_argument('--batch_size', help="Pages OCRed in one batch. Default: 4",
+                        default=4, type=int)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,83 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os
+import sys
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(
+                os.path.abspath(__file__)),
+            '../../')))
+
+from deepdoc.vision import Recognizer, LayoutRecognizer, TableStructureRecognizer, init_in_out
+from timeit import default_timer as timer
+import argparse
+import numpy as np
+
+
+def same(a, b, tol=1e-2):
+    if len(a) != len(b):
+        return False
+    for x, y in zip(a, b):
+        if x["type"] != y["type"] or np.max(np.abs(np.array(x["bbox"]) - np.array(y["bbox"]))) > tol:
+            return False
+    return True
+
+
+def benchmark(name, detr, images, thr, batch_size):
+    # warm up the session
+    Recognizer.__call__(detr, images[:1], thr, 1)
+
+    st = timer()
+    res1 = Recognizer.__call__(detr, images, thr, 1)
+    el1 = timer() - st
+    st = timer()
+    res2 = Recognizer.__call__(detr, images, thr, batch_size)
+    el2 = timer() - st
+
+    print("{}: batchable: {}".format(name, detr.batchable))
+    print("  one image per run: {:.2f}s, {:.2f} images/s".format(el1, len(images) / el1))
+    print("  batched({}): {:.2f}s, {:.2f} images/s, x{:.2f}".format(batch_size, el2, len(images) / el2, el1 / el2))
+    print("  same boxes: {}/{}".format(sum([1 for a, b in zip(res1, res2) if same(a, b)]), len(images)))
+
+
+def main(args):
+    images, _ = init_in_out(args)
+    if not images:
+        print("No image found.")
+        return
+    images = [np.array(img.convert("RGB")) for img in images]
+
+    if args.mode in ["layout", "all"]:
+        benchmark("layout", LayoutRecognizer("layout"), images, args.threshold, args.batch_size)
+    if args.mode in ["tsr", "all"]:
+        benchmark("tsr", TableStructureRecognizer(), images, args.threshold, args.batch_size)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--inputs',
+                        help="Directory where to store images or PDFs, or a file path to a single image or PDF",
+                        required=True)
+    parser.add_argument('--output_dir', help="Directory where to store the output images. Default: './layouts_outputs'",
+                        default="./layouts_outputs")
+    parser.add_argument('--mode', help="Model to benchmark: layout, tsr or all. Default: all",
+                        default="all", choices=["layout", "tsr", "all"])
+    parser.add_argument('--threshold', help="A threshold to filter out detections. Default: 0.2",
+                        default=0.2, type=float)
+    parser.add_argument('--batch_size', help="Images per session run. Default: 16",
+                        default=16, type=int)
+    args = parser.parse_args()
+    main(args)
@@ -68,6 +68,8 @@ class Cite(ComponentBase, ABC):
 
         if not kbinfos["chunks"]: return pd.DataFrame()
         df = pd.DataFrame(kbinfos["chunks"])
+        # the canvas state is json dumped with its outputs
+        df["vector"] = [v.tolist() for v in df["vector"]]
         df["content"] = df["content_with_weight"]
         del df["content_with_weight"]
         return df
@@ -80,6 +80,8 @@ class Retrieval(ComponentBase, ABC):
             return df
 
         df = pd.DataFrame(kbinfos["chunks"])
+        # the canvas state is json dumped with its outputs
+        df["vector"] = [v.tolist() for v in df["vector"]]
         df["content"] = df["content_with_weight"]
         del df["content_with_weight"]
         print(">>>>>>>>>>>>>>>>>>>>>>>>>>\n", query, df)
@@ -104,6 +104,7 @@ def chunk(filename, binary=None, from_page=0, to_page=100000,
         pdf_parser = Pdf() if kwargs.get(
             "parser_config", {}).get(
             "layout_recognize", True) else PlainParser()
+        pdf_parser.ocr_workers = int(kwargs.get("parser_config", {}).get("ocr_workers", 0))
         for txt, poss in pdf_parser(filename if not binary else binary,
                                     from_page=from_page, to_page=to_page, callback=callback)[0]:
             sections.append(txt + poss)
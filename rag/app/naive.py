@@ -205,6 +205,7 @@ def chunk(filename, binary=None, from_page=0, to_page=100000,
     elif re.search(r"\.pdf$", filename, re.IGNORECASE):
         pdf_parser = Pdf(
         ) if parser_config.get("layout_recognize", True) else PlainParser()
+        pdf_parser.ocr_workers = int(parser_config.get("ocr_workers", 0))
         sections, tbls = pdf_parser(filename if not binary else binary,
                                     from_page=from_page, to_page=to_page, callback=callback)
         res = tokenize_table(tbls, doc, eng)
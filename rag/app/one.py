@@ -71,6 +71,7 @@ def chunk(filename, binary=None, from_page=0, to_page=100000,
         pdf_parser = Pdf() if kwargs.get(
             "parser_config", {}).get(
             "layout_recognize", True) else PlainParser()
+        pdf_parser.ocr_workers = int(kwargs.get("parser_config", {}).get("ocr_workers", 0))
         sections, _ = pdf_parser(
             filename if not binary else binary, to_page=to_page, callback=callback)
         sections = [s for s, _ in sections if s]
@@ -148,6 +148,7 @@ def chunk(filename, binary=None, from_page=0, to_page=100000,
             }
         else:
             pdf_parser = Pdf()
+            pdf_parser.ocr_workers = int(kwargs.get("parser_config", {}).get("ocr_workers", 0))
             paper = pdf_parser(filename if not binary else binary,
                                from_page=from_page, to_page=to_page, callback=callback)
     else:
@@ -22,11 +22,12 @@ from ollama import Client
 from volcengine.maas.v2 import MaasService
 from rag.nlp import is_english
 from rag.utils import num_tokens_from_string
+from rag.utils.http_conn import http_client, httpx_kwargs, shared, secret_key, ZHIPUAI_BASE_URL
 
 
 class Base(ABC):
     def __init__(self, key, model_name, base_url):
-        self.client = OpenAI(api_key=key, base_url=base_url)
+        self.client = OpenAI(api_key=key, base_url=base_url, http_client=http_client(base_url))
         self.model_name = model_name
 
     def chat(self, system, history, gen_conf):
@@ -233,7 +234,7 @@ class QWenChat(Base):
 
 class ZhipuChat(Base):
     def __init__(self, key, model_name="glm-3-turbo", **kwargs):
-        self.client = ZhipuAI(api_key=key)
+        self.client = ZhipuAI(api_key=key, http_client=http_client(ZHIPUAI_BASE_URL))
         self.model_name = model_name
 
     def chat(self, system, history, gen_conf):
@@ -287,7 +288,8 @@ class ZhipuChat(Base):
 
 class OllamaChat(Base):
     def __init__(self, key, model_name, **kwargs):
-        self.client = Client(host=kwargs["base_url"])
+        self.client = shared(("ollama", kwargs["base_url"]),
+                             lambda: Client(host=kwargs["base_url"], **httpx_kwargs()))
         self.model_name = model_name
 
     def chat(self, system, history, gen_conf):
@@ -478,7 +480,7 @@ class MistralChat(Base):
 
     def __init__(self, key, model_name, base_url=None):
         from mistralai.client import MistralClient
-        self.client = MistralClient(api_key=key)
+        self.client = shared(("mistral", secret_key(key)), lambda: MistralClient(api_key=key))
         self.model_name = model_name
 
     def chat(self, system, history, gen_conf):
@@ -25,6 +25,7 @@ from io import BytesIO
 
 from api.utils import get_uuid
 from api.utils.file_utils import get_project_base_directory
+from rag.utils.http_conn import http_client, httpx_kwargs, shared, ZHIPUAI_BASE_URL
 
 
 class Base(ABC):
@@ -69,7 +70,7 @@ class Base(ABC):
 class GptV4(Base):
     def __init__(self, key, model_name="gpt-4-vision-preview", lang="Chinese", base_url="https://api.openai.com/v1"):
         if not base_url: base_url="https://api.openai.com/v1"
-        self.client = OpenAI(api_key=key, base_url=base_url)
+        self.client = OpenAI(api_key=key, base_url=base_url, http_client=http_client(base_url))
         self.model_name = model_name
         self.lang = lang
 
@@ -129,7 +130,7 @@ class QWenCV(Base):
 
 class Zhipu4V(Base):
     def __init__(self, key, model_name="glm-4v", lang="Chinese", **kwargs):
-        self.client = ZhipuAI(api_key=key)
+        self.client = ZhipuAI(api_key=key, http_client=http_client(ZHIPUAI_BASE_URL))
         self.model_name = model_name
         self.lang = lang
 
@@ -146,7 +147,8 @@ class Zhipu4V(Base):
 
 class OllamaCV(Base):
     def __init__(self, key, model_name, lang="Chinese", **kwargs):
-        self.client = Client(host=kwargs["base_url"])
+        self.client = shared(("ollama", kwargs["base_url"]),
+                             lambda: Client(host=kwargs["base_url"], **httpx_kwargs()))
         self.model_name = model_name
         self.lang = lang
 
@@ -168,7 +170,7 @@ class OllamaCV(Base):
 
 class XinferenceCV(Base):
     def __init__(self, key, model_name="", lang="Chinese", base_url=""):
-        self.client = OpenAI(api_key="xxx", base_url=base_url)
+        self.client = OpenAI(api_key="xxx", base_url=base_url, http_client=http_client(base_url))
         self.model_name = model_name
         self.lang = lang
 
@@ -16,7 +16,6 @@
 import re
 from typing import Optional
 import  threading
-import requests
 from huggingface_hub import snapshot_download
 from zhipuai import ZhipuAI
 import os
@@ -30,6 +29,8 @@ import numpy as np
 import asyncio
 from api.utils.file_utils import get_home_cache_dir
 from rag.utils import num_tokens_from_string, truncate
+from rag.utils import http_conn
+from rag.utils.http_conn import http_client, httpx_kwargs, shared, secret_key, ZHIPUAI_BASE_URL
 
 
 class Base(ABC):
@@ -94,7 +95,7 @@ class OpenAIEmbed(Base):
                  base_url="https://api.openai.com/v1"):
         if not base_url:
             base_url = "https://api.openai.com/v1"
-        self.client = OpenAI(api_key=key, base_url=base_url)
+        self.client = OpenAI(api_key=key, base_url=base_url, http_client=http_client(base_url))
         self.model_name = model_name
 
     def encode(self, texts: list, batch_size=32):
@@ -162,7 +163,7 @@ class QWenEmbed(Base):
 
 class ZhipuEmbed(Base):
     def __init__(self, key, model_name="embedding-2", **kwargs):
-        self.client = ZhipuAI(api_key=key)
+        self.client = ZhipuAI(api_key=key, http_client=http_client(ZHIPUAI_BASE_URL))
         self.model_name = model_name
 
     def encode(self, texts: list, batch_size=32):
@@ -183,7 +184,8 @@ class ZhipuEmbed(Base):
 
 class OllamaEmbed(Base):
     def __init__(self, key, model_name, **kwargs):
-        self.client = Client(host=kwargs["base_url"])
+        self.client = shared(("ollama", kwargs["base_url"]),
+                             lambda: Client(host=kwargs["base_url"], **httpx_kwargs()))
         self.model_name = model_name
 
     def encode(self, texts: list, batch_size=32):
@@ -238,7 +240,7 @@ class FastEmbed(Base):
 
 class XinferenceEmbed(Base):
     def __init__(self, key, model_name="", base_url=""):
-        self.client = OpenAI(api_key="xxx", base_url=base_url)
+        self.client = OpenAI(api_key="xxx", base_url=base_url, http_client=http_client(base_url))
         self.model_name = model_name
 
     def encode(self, texts: list, batch_size=32):
@@ -302,7 +304,7 @@ class JinaEmbed(Base):
             "input": texts,
             'encoding_type': 'float'
         }
-        res = requests.post(self.base_url, headers=self.headers, json=data).json()
+        res = http_conn.post(self.base_url, headers=self.headers, json=data).json()
         return np.array([d["embedding"] for d in res["data"]]), res["usage"]["total_tokens"]
 
     def encode_queries(self, text):
@@ -354,7 +356,7 @@ class MistralEmbed(Base):
     def __init__(self, key, model_name="mistral-embed",
                  base_url=None):
         from mistralai.client import MistralClient
-        self.client = MistralClient(api_key=key)
+        self.client = shared(("mistral", secret_key(key)), lambda: MistralClient(api_key=key))
         self.model_name = model_name
 
     def encode(self, texts: list, batch_size=32):
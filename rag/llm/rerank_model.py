@@ -15,7 +15,6 @@
 #
 import re
 import  threading
-import requests
 import torch
 from FlagEmbedding import FlagReranker
 from huggingface_hub import snapshot_download
@@ -24,6 +23,7 @@ from abc import ABC
 import numpy as np
 from api.utils.file_utils import get_home_cache_dir
 from rag.utils import num_tokens_from_string, truncate
+from rag.utils import http_conn
 
 def sigmoid(x):
     return 1 / (1 + np.exp(-x))
@@ -97,7 +97,7 @@ class JinaRerank(Base):
             "documents": texts,
             "top_n": len(texts)
         }
-        res = requests.post(self.base_url, headers=self.headers, json=data).json()
+        res = http_conn.post(self.base_url, headers=self.headers, json=data).json()
         return np.array([d["relevance_score"] for d in res["results"]]), res["usage"]["total_tokens"]
 
 
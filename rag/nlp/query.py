@@ -160,19 +160,42 @@ class EsQueryer:
             np.array(tksim) * tkweight, tksim, sims[0]
 
     def token_similarity(self, atks, btkss):
-        def toDict(tks):
-            d = {}
+        """
+        similarity() of the question against every candidate at once.
+        Only the question terms are weighed: a candidate counts through
+        which of them it contains and how many distinct terms it has.
+        A candidate is a token list or its precomputed term => weight.
+        """
+        import numpy as np
+        from scipy.sparse import csr_matrix
+
+        if isinstance(atks, str):
+            atks = atks.split(" ")
+        qtwt = {}
+        for t, c in self.tw.weights(atks):
+            if t not in qtwt:
+                qtwt[t] = 0
+            qtwt[t] += c
+        vocab = {t: i for i, t in enumerate(qtwt.keys())}
+        qw = np.array(list(qtwt.values()), dtype=np.float64)
+
+        rows, cols, dlen = [], [], np.zeros(len(btkss))
+        for i, tks in enumerate(btkss):
             if isinstance(tks, str):
                 tks = tks.split(" ")
-            for t, c in self.tw.weights(tks):
-                if t not in d:
-                    d[t] = 0
-                d[t] += c
-            return d
-
-        atks = toDict(atks)
-        btkss = [toDict(tks) for tks in btkss]
-        return [self.similarity(atks, btks) for btks in btkss]
+            # a dict is the term => weight stored with the chunk
+            tks = set(tks.keys()) if isinstance(tks, dict) else set(self.tw.terms(tks))
+            dlen[i] = len(tks)
+            for t in tks:
+                if t in vocab:
+                    rows.append(i)
+                    cols.append(vocab[t])
+        m = csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(btkss), len(vocab)))
+
+        s = m.dot(qw) + 1e-9
+        q = 1e-9 + np.sum(qw)
+        n = np.maximum(np.maximum(len(qtwt), dlen), 1)
+        return s / q / np.maximum(1, np.sqrt(np.log10(n)))
 
     def similarity(self, qtwt, dtwt):
         if isinstance(dtwt, type("")):
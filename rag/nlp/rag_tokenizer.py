@@ -21,6 +21,8 @@ import os
 import re
 import string
 import sys
+import threading
+from cachetools import LRUCache
 from hanziconv import HanziConv
 from huggingface_hub import snapshot_download
 from nltk import word_tokenize
@@ -28,7 +30,44 @@ from nltk.stem import PorterStemmer, WordNetLemmatizer
 from api.utils.file_utils import get_project_base_directory
 
 
+class TokenCache:
+    """
+    A bounded, thread safe LRU cache with hit/miss counters.
+    """
+    def __init__(self, maxsize):
+        self.cache = LRUCache(maxsize=maxsize)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, k):
+        with self.lock:
+            v = self.cache.get(k)
+            if v is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return v
+
+    def put(self, k, v):
+        with self.lock:
+            self.cache[k] = v
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"size": self.cache.currsize, "maxsize": self.cache.maxsize,
+                    "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / max(self.hits + self.misses, 1)}
+
+
 class RagTokenizer:
+    SENTENCE_CACHE_SIZE = 10000
+    TOKEN_CACHE_SIZE = 100000
+
     def key_(self, line):
         return str(line.lower().encode("utf-8"))[2:-1]
 
@@ -58,6 +97,11 @@ class RagTokenizer:
     def __init__(self, debug=False):
         self.DEBUG = debug
         self.DENOMINATOR = 1000000
+        # tokenize() results by sentence, segmentation results by token.
+        # Both depend on the trie so they are dropped whenever it changes.
+        self.sentence_cache_ = TokenCache(self.SENTENCE_CACHE_SIZE)
+        self.token_cache_ = TokenCache(self.TOKEN_CACHE_SIZE)
+        self.fine_grained_cache_ = TokenCache(self.TOKEN_CACHE_SIZE)
         self.trie_ = datrie.Trie(string.printable)
         self.DIR_ = os.path.join(get_project_base_directory(), "rag/res", "huqie")
 
@@ -77,13 +121,24 @@ class RagTokenizer:
     def loadUserDict(self, fnm):
         try:
             self.trie_ = datrie.Trie.load(fnm + ".trie")
-            return
         except Exception as e:
             self.trie_ = datrie.Trie(string.printable)
-        self.loadDict_(fnm)
+            self.loadDict_(fnm)
+        self.clear_cache()
 
     def addUserDict(self, fnm):
         self.loadDict_(fnm)
+        self.clear_cache()
+
+    def clear_cache(self):
+        self.sentence_cache_.clear()
+        self.token_cache_.clear()
+        self.fine_grained_cache_.clear()
+
+    def cache_stats(self):
+        return {"sentence": self.sentence_cache_.stats(),
+                "token": self.token_cache_.stats(),
+                "fine_grained": self.fine_grained_cache_.stats()}
 
     def _strQ2B(self, ustring):
         """把字符串全角转半角"""
@@ -152,6 +207,80 @@ class RagTokenizer:
 
         return self.dfs_(chars, s + 1, preTks, tkslist)
 
+    def bestTks_(self, chars, topn=1):
+        """
+        Same result as sortTks_() over the paths dfs_() enumerates, limited
+        to the first `topn`, but found by dynamic programming over the word
+        DAG instead of enumerating every path.
+
+        score_() is (B + L + F) / n for a path of n tokens, so paths are
+        grouped by (n, L, F). From the end of `chars` backwards, for every
+        position and number of single char tokens right before it (dfs_()
+        prunes on that), we keep per (n, L, F) of the suffix the `topn`
+        suffixes dfs_() would visit first.
+        """
+        B = 30
+        N = len(chars)
+
+        def edges(s, singles):
+            S = s + 1
+            if s + 2 <= N:
+                t1, t2 = chars[s:s + 1], chars[s:s + 2]
+                if self.trie_.has_keys_with_prefix(self.key_(t1)) and not self.trie_.has_keys_with_prefix(
+                        self.key_(t2)):
+                    S = s + 2
+            if singles >= 3 and self.trie_.has_keys_with_prefix(self.key_(chars[s - 1:s + 1])):
+                S = s + 2
+            res = []
+            for e in range(S, N + 1):
+                k = self.key_(chars[s:e])
+                if e > s + 1 and not self.trie_.has_keys_with_prefix(k):
+                    break
+                if k in self.trie_:
+                    res.append((e, self.trie_[k][0]))
+            if res:
+                return res
+            k = self.key_(chars[s:s + 1])
+            return [(s + 1, self.trie_[k][0] if k in self.trie_ else -12)]
+
+        # suffixes[s][singles]: {(n, L, F): [path, ...]}, a path being a
+        # linked list (end, rest) of token end positions.
+        suffixes = [[{} for _ in range(4)] for _ in range(N)] + [[{(0, 0, 0): [None]}] * 4]
+        for s in range(N - 1, -1, -1):
+            for singles in range(min(s, 3) + 1):
+                res = {}
+                for e, f in edges(s, singles):
+                    l = 0 if e - s < 2 else 1
+                    nxt = suffixes[e][min(singles + 1, 3) if e == s + 1 else 0]
+                    for (n, L, F), paths in nxt.items():
+                        k = (n + 1, L + l, F + f)
+                        if k not in res:
+                            res[k] = []
+                        # ends are tried in ascending order, so are the paths of dfs_()
+                        for p in paths[:topn - len(res[k])]:
+                            res[k].append((e, p))
+                # Suffixes of the same length get the same prefix, so those whose
+                # L + F is below the `topn` best can never be in the result.
+                best = {}
+                for n, L, F in res.keys():
+                    best.setdefault(n, set()).add(L + F)
+                best = {n: sorted(v, reverse=True)[:topn] for n, v in best.items()}
+                suffixes[s][singles] = {k: v for k, v in res.items() if k[1] + k[2] >= best[k[0]][-1]}
+
+        res = []
+        for (n, L, F), paths in suffixes[0][0].items():
+            F /= n
+            L /= n
+            sc = B / n + L + F
+            for p in paths:
+                ends = []
+                while p:
+                    ends.append(p[0])
+                    p = p[1]
+                res.append((ends, sc))
+        res = sorted(res, key=lambda x: (-x[1], x[0]))[:topn]
+        return [([chars[b:e] for b, e in zip([0] + ends[:-1], ends)], sc) for ends, sc in res]
+
     def freq(self, tk):
         k = self.key_(tk)
         if k not in self.trie_:
@@ -259,6 +388,13 @@ class RagTokenizer:
         return [self.stemmer.stem(self.lemmatizer.lemmatize(t)) if re.match(r"[a-zA-Z_-]+$", t) else t for t in tks]
 
     def tokenize(self, line):
+        res = self.sentence_cache_.get(line)
+        if res is None:
+            res = self.tokenize_(line)
+            self.sentence_cache_.put(line, res)
+        return res
+
+    def tokenize_(self, line):
         line = self._strQ2B(line).lower()
         line = self._tradi2simp(line)
         zh_num = len([1 for c in line if is_chinese(c)])
@@ -273,48 +409,54 @@ class RagTokenizer:
                 res.append(L)
                 continue
             # print(L)
-
-            # use maxforward for the first time
-            tks, s = self.maxForward_(L)
-            tks1, s1 = self.maxBackward_(L)
-            if self.DEBUG:
-                print("[FW]", tks, s)
-                print("[BW]", tks1, s1)
-
-            diff = [0 for _ in range(max(len(tks1), len(tks)))]
-            for i in range(min(len(tks1), len(tks))):
-                if tks[i] != tks1[i]:
-                    diff[i] = 1
-
-            if s1 > s:
-                tks = tks1
-
-            i = 0
-            while i < len(tks):
-                s = i
-                while s < len(tks) and diff[s] == 0:
-                    s += 1
-                if s == len(tks):
-                    res.append(" ".join(tks[i:]))
-                    break
-                if s > i:
-                    res.append(" ".join(tks[i:s]))
-
-                e = s
-                while e < len(tks) and e - s < 5 and diff[e] == 1:
-                    e += 1
-
-                tkslist = []
-                self.dfs_("".join(tks[s:e + 1]), 0, [], tkslist)
-                res.append(" ".join(self.sortTks_(tkslist)[0][0]))
-
-                i = e + 1
+            tks = self.token_cache_.get(L)
+            if tks is None:
+                tks = self.segment_(L)
+                self.token_cache_.put(L, tks)
+            res.extend(tks)
 
         res = " ".join(self.english_normalize_(res))
         if self.DEBUG:
             print("[TKS]", self.merge_(res))
         return self.merge_(res)
 
+    def segment_(self, L):
+        res = []
+        # use maxforward for the first time
+        tks, s = self.maxForward_(L)
+        tks1, s1 = self.maxBackward_(L)
+        if self.DEBUG:
+            print("[FW]", tks, s)
+            print("[BW]", tks1, s1)
+
+        diff = [0 for _ in range(max(len(tks1), len(tks)))]
+        for i in range(min(len(tks1), len(tks))):
+            if tks[i] != tks1[i]:
+                diff[i] = 1
+
+        if s1 > s:
+            tks = tks1
+
+        i = 0
+        while i < len(tks):
+            s = i
+            while s < len(tks) and diff[s] == 0:
+                s += 1
+            if s == len(tks):
+                res.append(" ".join(tks[i:]))
+                break
+            if s > i:
+                res.append(" ".join(tks[i:s]))
+
+            e = s
+            while e < len(tks) and e - s < 5 and diff[e] == 1:
+                e += 1
+
+            res.append(" ".join(self.bestTks_("".join(tks[s:e + 1]))[0][0]))
+
+            i = e + 1
+        return res
+
     def fine_grained_tokenize(self, tks):
         tks = tks.split(" ")
         zh_num = len([1 for c in tks if c and is_chinese(c[0])])
@@ -326,35 +468,37 @@ class RagTokenizer:
 
         res = []
         for tk in tks:
-            if len(tk) < 3 or re.match(r"[0-9,\.-]+$", tk):
-                res.append(tk)
-                continue
-            tkslist = []
-            if len(tk) > 10:
-                tkslist.append(tk)
-            else:
-                self.dfs_(tk, 0, [], tkslist)
-            if len(tkslist) < 2:
-                res.append(tk)
-                continue
-            stk = self.sortTks_(tkslist)[1][0]
-            if len(stk) == len(tk):
-                stk = tk
-            else:
-                if re.match(r"[a-z\.-]+$", tk):
-                    for t in stk:
-                        if len(t) < 3:
-                            stk = tk
-                            break
-                    else:
-                        stk = " ".join(stk)
-                else:
-                    stk = " ".join(stk)
-
+            stk = self.fine_grained_cache_.get(tk)
+            if stk is None:
+                stk = self.fine_grained_token_(tk)
+                self.fine_grained_cache_.put(tk, stk)
             res.append(stk)
 
         return " ".join(self.english_normalize_(res))
 
+    def fine_grained_token_(self, tk):
+        if len(tk) < 3 or re.match(r"[0-9,\.-]+$", tk):
+            return tk
+        if len(tk) > 10:
+            return tk
+        tkslist = self.bestTks_(tk, 2)
+        if len(tkslist) < 2:
+            return tk
+        stk = tkslist[1][0]
+        if len(stk) == len(tk):
+            stk = tk
+        else:
+            if re.match(r"[a-z\.-]+$", tk):
+                for t in stk:
+                    if len(t) < 3:
+                        stk = tk
+                        break
+                else:
+                    stk = " ".join(stk)
+            else:
+                stk = " ".join(stk)
+        return stk
+
 
 def is_chinese(s):
     if s >= u'\u4e00' and s <= u'\u9fa5':
@@ -395,6 +539,7 @@ tag = tokenizer.tag
 freq = tokenizer.freq
 loadUserDict = tokenizer.loadUserDict
 addUserDict = tokenizer.addUserDict
+cache_stats = tokenizer.cache_stats
 tradi2simp = tokenizer._tradi2simp
 strQ2B = tokenizer._strQ2B
 
@@ -15,7 +15,10 @@
 #
 
 import json
+import os
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 
 from elasticsearch_dsl import Q, Search
@@ -24,6 +27,9 @@ from dataclasses import dataclass
 
 from rag.settings import es_logger
 from rag.utils import rmSpace
+from rag.utils.embedding_cache import QUERY_EMBD_CACHE, model_name
+from rag.utils.redis_conn import REDIS_CONN
+from cachetools import TTLCache
 from rag.nlp import rag_tokenizer, query
 import numpy as np
 
@@ -31,6 +37,17 @@ import numpy as np
 def index_name(uid): return f"ragflow_{uid}"
 
 
+def kb_version_key(kb_id): return f"kb_version:{kb_id}"
+
+
+def bump_kb_version(kb_ids):
+    """ The chunks of these KBs changed: cached retrieval results of them are stale. """
+    if isinstance(kb_ids, str):
+        kb_ids = [kb_ids]
+    for kb_id in set(kb_ids):
+        REDIS_CONN.incr(kb_version_key(kb_id))
+
+
 class Dealer:
     def __init__(self, es):
         self.qryr = query.EsQueryer(es)
@@ -42,6 +59,11 @@ class Dealer:
             "content_ltks^2",
             "content_sm_ltks"]
         self.es = es
+        self.retrieval_cache = TTLCache(maxsize=int(os.environ.get("RETRIEVAL_CACHE_SIZE", 1024)),
+                                        ttl=int(os.environ.get("RETRIEVAL_CACHE_TTL", 600)))
+        self.retrieval_cache_lock = threading.Lock()
+        self.two_phase = int(os.environ.get("RETRIEVAL_TWO_PHASE", 1)) > 0
+        self.fanout_pool = ThreadPoolExecutor(max_workers=int(os.environ.get("RETRIEVAL_FANOUT_WORKERS", 4)))
 
     @dataclass
     class SearchResult:
@@ -53,9 +75,10 @@ class Dealer:
         aggregation: Union[List, Dict, None] = None
         keywords: Optional[List[str]] = None
         group_docs: List[List] = None
+        vectors: Optional[np.ndarray] = None
 
     def _vector(self, txt, emb_mdl, sim=0.8, topk=10):
-        qv, c = emb_mdl.encode_queries(txt)
+        qv = QUERY_EMBD_CACHE.encode_queries(emb_mdl, txt)
         return {
             "field": "q_%d_vec" % len(qv),
             "k": topk,
@@ -116,7 +139,8 @@ class Dealer:
         # 定义需要返回的字段列表
         src = req.get("fields", ["docnm_kwd", "content_ltks", "kb_id", "img_id", "title_tks", "important_kwd",
                                 "image_id", "doc_id", "q_512_vec", "q_768_vec", "position_int",
-                                "q_1024_vec", "q_1536_vec", "available_int", "content_with_weight"])
+                                "q_1024_vec", "q_1536_vec", "available_int", "content_with_weight",
+                                "term_weights_with_weight"])
         
         # 设置分页和高亮
         s = s.query(bqry)[pg * ps:(pg + 1) * ps]
@@ -162,6 +186,10 @@ class Dealer:
                 del s["highlight"]
             q_vec = s["knn"]["query_vector"]
         
+        # 只取与查询向量维度一致的向量字段
+        if q_vec:
+            src = [f for f in src if not re.match(r"q_[0-9]+_vec$", f) or f == "q_%d_vec" % len(q_vec)]
+
         # 执行搜索
         es_logger.info("【Q】: {}".format(json.dumps(s)))
         # print("idxnm:", idxnm)
@@ -199,9 +227,60 @@ class Dealer:
             aggregation=aggs,                   # 聚合结果
             highlight=self.getHighlight(res),   # 高亮结果
             field=self.getFields(res, src),     # 字段值
-            keywords=list(kwds)                 # 关键词列表
+            keywords=list(kwds),                # 关键词列表
+            vectors=self.getVectors(res, "q_%d_vec" % len(q_vec), len(q_vec)) if q_vec else None  # 向量矩阵
         )
 
+    def search_indices(self, req, indices, emb_mdl=None):
+        """
+        search() over several indices, {index name: kb_ids}, concurrently,
+        merged into one SearchResult. Also returns the index of every chunk.
+        """
+        if len(indices) == 1:
+            idxnm, kb_ids = list(indices.items())[0]
+            sres = self.search(dict(req, kb_ids=kb_ids), idxnm, emb_mdl)
+            return sres, {id: idxnm for id in sres.ids}
+        if req.get("vector") and req.get("question"):
+            # 先算好问题向量，各个检索线程直接命中缓存
+            QUERY_EMBD_CACHE.encode_queries(emb_mdl, req["question"])
+        futs = [(idxnm, self.fanout_pool.submit(self.search, dict(req, kb_ids=kb_ids), idxnm, emb_mdl))
+                for idxnm, kb_ids in indices.items()]
+        sres, chunk_idx = None, {}
+        for idxnm, fut in futs:
+            r = fut.result()
+            for id in r.ids:
+                chunk_idx[id] = idxnm
+            if sres is None:
+                sres = r
+                continue
+            sres.total += r.total
+            sres.ids.extend(r.ids)
+            sres.query_vector = sres.query_vector or r.query_vector
+            sres.field.update(r.field)
+            sres.highlight.update(r.highlight)
+            sres.aggregation = (sres.aggregation or []) + (r.aggregation or []) or None
+            sres.keywords = list(set(sres.keywords) | set(r.keywords))
+            if r.vectors is not None:
+                sres.vectors = r.vectors if sres.vectors is None else np.vstack([sres.vectors, r.vectors])
+        return sres, chunk_idx
+
+    def hydrate_indices(self, sres, ids, chunk_idx, flds):
+        """ hydrate() for chunks spread over the indices recorded by search_indices(). """
+        by_idx = {}
+        for id in ids:
+            by_idx.setdefault(chunk_idx[id], []).append(id)
+        for idxnm, ids in by_idx.items():
+            self.hydrate(sres, ids, idxnm, flds)
+
+    def hydrate(self, sres, ids, idxnm, flds):
+        """ Adds the fields `flds` of the chunks `ids` to sres.field, fetched by id. """
+        if not ids:
+            return
+        for id, m in self.getFields({"hits": {"hits": self.es.mget(ids, idxnm, flds)}}, flds).items():
+            if id not in sres.field:
+                sres.field[id] = {}
+            sres.field[id].update(m)
+
     def getAggregation(self, res, g):
         if not "aggregations" in res or "aggs_" + g not in res["aggregations"]:
             return
@@ -235,7 +314,8 @@ class Dealer:
         if not flds:
             return {}
         for d in self.es.getSource(sres):
-            m = {n: d.get(n) for n in flds if d.get(n) is not None}
+            # dense vectors are carried by getVectors()
+            m = {n: d.get(n) for n in flds if d.get(n) is not None and not re.match(r"q_[0-9]+_vec$", n)}
             for n, v in m.items():
                 if isinstance(v, type([])):
                     m[n] = "\t".join([str(vv) if not isinstance(
@@ -250,29 +330,31 @@ class Dealer:
                 res[d["id"]] = m
         return res
 
+    def getVectors(self, sres, fld, dim):
+        """
+        The dense vectors of the hits as a float32 matrix, one row per hit
+        in the order of getDocIds(). Hits missing the field get a zero row.
+        """
+        hits = sres["hits"]["hits"]
+        vecs = np.zeros((len(hits), dim), dtype=np.float32)
+        for i, d in enumerate(hits):
+            v = d.get("_source", {}).get(fld)
+            if v:
+                vecs[i] = v
+        return vecs
+
     @staticmethod
     def trans2floats(txt):
         return [float(t) for t in txt.split("\t")]
 
-    def insert_citations(self, answer, chunks, chunk_v,
-                         embd_mdl, tkweight=0.1, vtweight=0.9):
+    @staticmethod
+    def split_answer(answer):
         """
-        为回答插入引用标记
-        
-        Args:
-            answer: 需要添加引用的回答文本
-            chunks: 知识库中的文本片段列表
-            chunk_v: 知识库文本片段的向量表示
-            embd_mdl: 嵌入模型,用于计算文本向量
-            tkweight: token相似度权重,默认0.1
-            vtweight: 向量相似度权重,默认0.9
-            
+        按代码块和句子切分回答
+
         Returns:
-            tuple: (添加引用后的文本, 引用的chunk索引集合)
+            tuple: (全部片段, 参与引用的片段下标, 参与引用的片段)
         """
-        # 确保chunks和chunk_v长度一致
-        assert len(chunks) == len(chunk_v)
-        
         # 按代码块和句子分割文本
         pieces = re.split(r"(```)", answer)
         if len(pieces) >= 3:  # 包含代码块
@@ -311,6 +393,30 @@ class Dealer:
                 continue
             idx.append(i)
             pieces_.append(t)
+        return pieces, idx, pieces_
+
+    def insert_citations(self, answer, chunks, chunk_v,
+                         embd_mdl, tkweight=0.1, vtweight=0.9):
+        """
+        为回答插入引用标记
+        
+        Args:
+            answer: 需要添加引用的回答文本
+            chunks: 知识库中的文本片段列表
+            chunk_v: 知识库文本片段的向量表示
+            embd_mdl: 嵌入模型,用于计算文本向量
+            tkweight: token相似度权重,默认0.1
+            vtweight: 向量相似度权重,默认0.9
+            
+        Returns:
+            tuple: (添加引用后的文本, 引用的chunk索引集合)
+        """
+        # 确保chunks和chunk_v长度一致
+        assert len(chunks) == len(chunk_v)
+        if len(chunk_v):
+            chunk_v = np.vstack(chunk_v).astype(np.float32, copy=False)
+        
+        pieces, idx, pieces_ = self.split_answer(answer)
         es_logger.info("{} => {}".format(answer, pieces_))
         if not pieces_:
             return answer, set([])
@@ -364,25 +470,45 @@ class Dealer:
 
         return res, seted
 
+    @staticmethod
+    def chunk_tokens(d, cfield="content_ltks"):
+        """ The tokens of a chunk rerank compares the question with. """
+        important_kwd = d.get("important_kwd", [])
+        if isinstance(important_kwd, str):
+            important_kwd = [important_kwd]
+        title_tks = [t for t in d.get("title_tks", "").split(" ") if t]
+        return d[cfield].split(" ") + title_tks + important_kwd
+
+    def term_weights(self, d):
+        """
+        The chunk's term => weight, stored at index time as
+        term_weights_with_weight so that rerank doesn't weigh the chunk's
+        tokens again on every query.
+        """
+        tw = {}
+        for t, c in self.qryr.tw.weights(self.chunk_tokens(d)):
+            tw[t] = tw.get(t, 0) + (0 if np.isnan(c) else float(c))
+        return json.dumps({t: round(c, 5) for t, c in tw.items()}, ensure_ascii=False, separators=(",", ":"))
+
+    def chunk_term_weights(self, d, cfield="content_ltks"):
+        if cfield == "content_ltks" and d.get("term_weights_with_weight"):
+            try:
+                return json.loads(d["term_weights_with_weight"])
+            except Exception as e:
+                es_logger.warning("Bad term weights: " + str(e))
+        return self.chunk_tokens(d, cfield)
+
     def rerank(self, sres, query, tkweight=0.3,
                vtweight=0.7, cfield="content_ltks"):
         _, keywords = self.qryr.question(query)
-        ins_embd = [
-            Dealer.trans2floats(
-                sres.field[i].get("q_%d_vec" % len(sres.query_vector), "\t".join(["0"] * len(sres.query_vector)))) for i in sres.ids]
-        if not ins_embd:
+        if not sres.ids:
             return [], [], []
+        ins_embd = sres.vectors
 
         for i in sres.ids:
             if isinstance(sres.field[i].get("important_kwd", []), str):
                 sres.field[i]["important_kwd"] = [sres.field[i]["important_kwd"]]
-        ins_tw = []
-        for i in sres.ids:
-            content_ltks = sres.field[i][cfield].split(" ")
-            title_tks = [t for t in sres.field[i].get("title_tks", "").split(" ") if t]
-            important_kwd = sres.field[i].get("important_kwd", [])
-            tks = content_ltks + title_tks + important_kwd
-            ins_tw.append(tks)
+        ins_tw = [self.chunk_term_weights(sres.field[i], cfield) for i in sres.ids]
 
         sim, tksim, vtsim = self.qryr.hybrid_similarity(sres.query_vector,
                                                         ins_embd,
@@ -397,16 +523,11 @@ class Dealer:
         for i in sres.ids:
             if isinstance(sres.field[i].get("important_kwd", []), str):
                 sres.field[i]["important_kwd"] = [sres.field[i]["important_kwd"]]
-        ins_tw = []
-        for i in sres.ids:
-            content_ltks = sres.field[i][cfield].split(" ")
-            title_tks = [t for t in sres.field[i].get("title_tks", "").split(" ") if t]
-            important_kwd = sres.field[i].get("important_kwd", [])
-            tks = content_ltks + title_tks + important_kwd
-            ins_tw.append(tks)
+        ins_tw = [self.chunk_term_weights(sres.field[i], cfield) for i in sres.ids]
+        ins_tks = [self.chunk_tokens(sres.field[i], cfield) for i in sres.ids]
 
         tksim = self.qryr.token_similarity(keywords, ins_tw)
-        vtsim,_ = rerank_mdl.similarity(" ".join(keywords), [rmSpace(" ".join(tks)) for tks in ins_tw])
+        vtsim,_ = rerank_mdl.similarity(" ".join(keywords), [rmSpace(" ".join(tks)) for tks in ins_tks])
 
         return tkweight*np.array(tksim) + vtweight*vtsim, tksim, vtsim
 
@@ -424,6 +545,19 @@ class Dealer:
         # 如果问题为空，则返回空结果
         if not question:
             return ranks
+        # 结果缓存：知识库有变动时版本号递增，旧结果不再命中
+        cache_key = None
+        if self.retrieval_cache.maxsize > 0 and REDIS_CONN.is_alive():
+            versions = REDIS_CONN.mget([kb_version_key(kb) for kb in kb_ids])
+            if versions is not None:
+                cache_key = json.dumps([tenant_id, kb_ids, doc_ids, re.sub(r"\s+", " ", question).strip(), page,
+                                        page_size, similarity_threshold, vector_similarity_weight, top, aggs,
+                                        model_name(embd_mdl), model_name(rerank_mdl) if rerank_mdl else "",
+                                        versions], ensure_ascii=False, default=str)
+                with self.retrieval_cache_lock:
+                    res = self.retrieval_cache.get(cache_key)
+                if res is not None:
+                    return deepcopy(res)
         # 构建检索请求
         req = {"kb_ids": kb_ids, "doc_ids": doc_ids, "size": page_size,
                "question": question, "vector": True, "topk": top,
@@ -431,13 +565,24 @@ class Dealer:
                "available_int": 1}
         # print("Search request:", req)
         # 执行检索
-        kb_id = req["kb_ids"][0]
-        shared = KnowledgebaseService.is_shared(kb_id)
-        if shared == 1:
-            admin_id = UserService.get_admin_id()
-            # admin_id = "6e4490ee7c7911efa44bb42e99cad8a4"
-            tenant_id = admin_id
-        sres = self.search(req, index_name(tenant_id), embd_mdl)
+        # 共享知识库的切片在管理员的索引里
+        indices = {}
+        for kb_id in kb_ids:
+            uid = tenant_id
+            if KnowledgebaseService.is_shared(kb_id) == 1:
+                uid = UserService.get_admin_id()
+            indices.setdefault(index_name(uid), []).append(kb_id)
+        # 两阶段检索：先只取重排所需字段，分页后再按id取全文
+        if self.two_phase:
+            req["fields"] = ["title_tks", "important_kwd", "term_weights_with_weight",
+                             "q_512_vec", "q_768_vec", "q_1024_vec", "q_1536_vec"]
+            if rerank_mdl:
+                req["fields"].append("content_ltks")
+        sres, chunk_idx = self.search_indices(req, indices, embd_mdl)
+        if self.two_phase and not rerank_mdl:
+            # 旧的切片没有预计算的词权重
+            self.hydrate_indices(sres, [i for i in sres.ids if not sres.field.get(i, {}).get("term_weights_with_weight")],
+                                 chunk_idx, ["content_ltks"])
         es_logger.info(f"Search results count: {len(sres.ids) if sres.ids else 0}")
         # 如果重排序模型存在，则使用重排序模型
         if rerank_mdl:
@@ -449,11 +594,10 @@ class Dealer:
                 sres, question, 1 - vector_similarity_weight, vector_similarity_weight)
         # 获取排序后的索引
         idx = np.argsort(sim * -1)
-        # 获取嵌入维度
-        dim = len(sres.query_vector)
         # 获取起始索引
         start_idx = (page - 1) * page_size
-        # 遍历排序后的索引
+        # 遍历排序后的索引，选出当前页
+        page_idx = []
         for i in idx:
             # 如果相似度小于阈值，则跳出循环
             if sim[i] < similarity_threshold:
@@ -466,12 +610,23 @@ class Dealer:
             if start_idx >= 0:
                 continue
             # 如果文档数大于等于页面大小，则跳过
-            if len(ranks["chunks"]) >= page_size:
+            if len(page_idx) >= page_size:
                 if aggs:
                     continue
                 break
+            page_idx.append(i)
+
+        # 两阶段检索的第二阶段：只取当前页切片的全文
+        if self.two_phase:
+            self.hydrate_indices(sres, [sres.ids[i] for i in page_idx], chunk_idx,
+                                 ["docnm_kwd", "content_ltks", "content_with_weight", "doc_id", "kb_id", "img_id",
+                                  "position_int"])
+        for i in page_idx:
             # 获取文档ID
             id = sres.ids[i]
+            # 两次请求之间被删除的切片
+            if "content_with_weight" not in sres.field.get(id, {}):
+                continue
             # 获取文档名称
             dnm = sres.field[id]["docnm_kwd"]
             # 获取文档ID
@@ -489,17 +644,17 @@ class Dealer:
                 "similarity": sim[i],
                 "vector_similarity": vsim[i],
                 "term_similarity": tsim[i],
-                "vector": self.trans2floats(sres.field[id].get("q_%d_vec" % dim, "\t".join(["0"] * dim))),
+                "vector": sres.vectors[i],
                 "positions": sres.field[id].get("position_int", "").split("\t")
             }
             # 如果位置数是5的倍数，则转换为浮点数
             if len(d["positions"]) % 5 == 0:
                 poss = []
                 # 遍历位置数
-                for i in range(0, len(d["positions"]), 5):
+                for j in range(0, len(d["positions"]), 5):
                     # 将位置数转换为浮点数
-                    poss.append([float(d["positions"][i]), float(d["positions"][i + 1]), float(d["positions"][i + 2]),
-                                 float(d["positions"][i + 3]), float(d["positions"][i + 4])])
+                    poss.append([float(d["positions"][j]), float(d["positions"][j + 1]), float(d["positions"][j + 2]),
+                                 float(d["positions"][j + 3]), float(d["positions"][j + 4])])
                 d["positions"] = poss
             # 将文档添加到结果中
             ranks["chunks"].append(d)
@@ -514,6 +669,9 @@ class Dealer:
                               "count": v["count"]} for k,
                              v in sorted(ranks["doc_aggs"].items(),
                                          key=lambda x:x[1]["count"] * -1)]
+        if cache_key:
+            with self.retrieval_cache_lock:
+                self.retrieval_cache[cache_key] = deepcopy(ranks)
         # 返回结果
         return ranks
 
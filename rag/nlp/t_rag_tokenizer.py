@@ -0,0 +1,121 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os
+import re
+import sys
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(
+                os.path.abspath(__file__)),
+            '../../')))
+
+from rag.nlp.rag_tokenizer import RagTokenizer
+from timeit import default_timer as timer
+import argparse
+
+CORPUS = [
+    "公开征求意见稿提出，境外投资者可使用自有人民币或外汇投资。使用外汇投资的，可通过债券持有人在香港人民币业务清算行及香港地区经批准可进入境内银行间外汇市场进行交易的境外人民币业务参加行（以下统称香港结算行）办理外汇资金兑换。香港结算行由此所产生的头寸可到境内银行间外汇市场平盘。使用外汇投资的，在其投资的债券到期或卖出后，原则上应兑换回外汇。",
+    "多校划片就是一个小区对应多个小学初中，让买了学区房的家庭也不确定到底能上哪个学校。目的是通过这种方式为学区房降温，把就近入学落到实处。南京市长江大桥",
+    "实际上当时他们已经将业务中心偏移到安全部门和针对政府企业的部门 Scripts are compiled and cached aaaaaaaaa",
+    "虽然我不怎么玩",
+    "蓝月亮如何在外资夹击中生存,那是全宇宙最有意思的",
+    "涡轮增压发动机num最大功率,不像别的共享买车锁电子化的手段,我们接过来是否有意义,黄黄爱美食,不过，今天阿奇要讲到的这家农贸市场，说实话，还真蛮有特色的！不仅环境好，还打出了",
+    "这周日你去吗？这周日你有空吗？",
+    "Unity3D开发经验 测试开发工程师 c++双11双11 985 211 ",
+    "数据分析项目经理|数据分析挖掘|数据分析方向|商品数据分析|搜索数据分析 sql python hive tableau Cocos2d-",
+    "哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈",
+]
+
+
+def dfs_best(tknzr, chars, topn):
+    tkslist = []
+    tknzr.dfs_(chars, 0, [], tkslist)
+    return [tks for tks, _ in tknzr.sortTks_(tkslist)[:topn]]
+
+
+def dp_best(tknzr, chars, topn):
+    return [tks for tks, _ in tknzr.bestTks_(chars, topn)]
+
+
+def parity(tknzr, lines, max_len):
+    """ Every window of every CJK run up to `max_len` chars, top 2 paths. """
+    n, diff = 0, []
+    for line in lines:
+        for run in re.findall(r"[一-龥]+", line):
+            for i in range(len(run)):
+                for j in range(i + 1, min(len(run), i + max_len) + 1):
+                    n += 1
+                    a = dfs_best(tknzr, run[i:j], 2)
+                    b = dp_best(tknzr, run[i:j], 2)
+                    if a != b:
+                        diff.append((run[i:j], a, b))
+    return n, diff
+
+
+def benchmark(tknzr, paragraph, lengths, budget):
+    dfs_done = True
+    for L in lengths:
+        chars = paragraph[:L]
+        el1 = None
+        if dfs_done:
+            st = timer()
+            dfs_best(tknzr, chars, 2)
+            el1 = timer() - st
+            dfs_done = el1 < budget
+        st = timer()
+        dp_best(tknzr, chars, 2)
+        el2 = timer() - st
+        if el1 is None:
+            print("chars: {:4d}, dfs_: skipped, bestTks_: {:.4f}s".format(L, el2))
+        else:
+            print("chars: {:4d}, dfs_: {:.4f}s, bestTks_: {:.4f}s, x{:.1f}".format(L, el1, el2, el1 / el2))
+
+
+def main(args):
+    tknzr = RagTokenizer()
+    lines = CORPUS
+    if args.inputs:
+        with open(args.inputs, "r", encoding="utf-8") as f:
+            lines = [l.strip() for l in f if l.strip()]
+
+    st = timer()
+    n, diff = parity(tknzr, lines, args.max_len)
+    print("parity: {}/{} windows identical, {:.2f}s".format(n - len(diff), n, timer() - st))
+    for chars, a, b in diff[:10]:
+        print("  {}\n    dfs_: {}\n    bestTks_: {}".format(chars, a, b))
+
+    paragraph = "".join(re.findall(r"[一-龥]+", "".join(lines[:-1] if len(lines) > 1 else lines)))
+    lengths = [L for L in [8, 12, 16, 20, 24, 32, 48, 64, 128, 256] if L <= len(paragraph)]
+    benchmark(tknzr, paragraph, lengths, args.budget)
+
+    tknzr.clear_cache()
+    st = timer()
+    for line in lines:
+        tknzr.fine_grained_tokenize(tknzr.tokenize(line))
+    print("tokenize + fine_grained_tokenize: {} lines, {:.4f}s".format(len(lines), timer() - st))
+    if diff:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--inputs', help="Text file, one paragraph per line. Default: built-in corpus")
+    parser.add_argument('--max_len', help="Longest window compared for parity. Default: 12",
+                        default=12, type=int)
+    parser.add_argument('--budget', help="Stop timing dfs_ once one run takes more seconds than this. Default: 10",
+                        default=10, type=float)
+    args = parser.parse_args()
+    main(args)
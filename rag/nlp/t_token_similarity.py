@@ -0,0 +1,91 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os
+import random
+import sys
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(
+                os.path.abspath(__file__)),
+            '../../')))
+
+from rag.nlp import rag_tokenizer
+from rag.nlp.query import EsQueryer
+from rag.nlp.t_rag_tokenizer import CORPUS
+from timeit import default_timer as timer
+import argparse
+import numpy as np
+
+
+def token_similarity(qryr, atks, btkss):
+    """ EsQueryer.token_similarity before it was vectorized. """
+    def toDict(tks):
+        d = {}
+        if isinstance(tks, str):
+            tks = tks.split(" ")
+        for t, c in qryr.tw.weights(tks):
+            if t not in d:
+                d[t] = 0
+            d[t] += c
+        return d
+
+    atks = toDict(atks)
+    btkss = [toDict(tks) for tks in btkss]
+    return [qryr.similarity(atks, btks) for btks in btkss]
+
+
+def main(args):
+    qryr = EsQueryer(None)
+    lines = CORPUS
+    if args.inputs:
+        with open(args.inputs, "r", encoding="utf-8") as f:
+            lines = [l.strip() for l in f if l.strip()]
+    tks = rag_tokenizer.tokenize(" ".join(lines)).split(" ")
+
+    random.seed(0)
+    candidates = []
+    for _ in range(args.candidates):
+        i = random.randint(0, max(0, len(tks) - args.chunk_tokens))
+        candidates.append(tks[i: i + args.chunk_tokens])
+    questions = [rag_tokenizer.tokenize(l[:24]).split(" ") for l in lines]
+
+    el1, el2, diff = 0, 0, 0
+    for q in questions:
+        _, keywords = qryr.question(" ".join(q))
+        st = timer()
+        sim1 = token_similarity(qryr, keywords, candidates)
+        el1 += timer() - st
+        st = timer()
+        sim2 = qryr.token_similarity(keywords, candidates)
+        el2 += timer() - st
+        diff = max(diff, np.max(np.abs(np.array(sim1) - sim2)))
+
+    n = len(questions)
+    print("candidates: {}, questions: {}".format(len(candidates), n))
+    print("per-candidate: {:.2f}ms/query".format(el1 / n * 1000))
+    print("vectorized: {:.2f}ms/query, x{:.1f}".format(el2 / n * 1000, el1 / el2))
+    print("max abs diff: {:.2e}".format(diff))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--inputs', help="Text file, one paragraph per line. Default: built-in corpus")
+    parser.add_argument('--candidates', help="Candidates reranked per question. Default: 1024",
+                        default=1024, type=int)
+    parser.add_argument('--chunk_tokens', help="Tokens per candidate. Default: 128",
+                        default=128, type=int)
+    args = parser.parse_args()
+    main(args)
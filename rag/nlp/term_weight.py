@@ -77,6 +77,7 @@ class Dealer:
                 return set(res.keys())
             return res
 
+        self.terms_cache_ = rag_tokenizer.TokenCache(100000)
         fnm = os.path.join(get_project_base_directory(), "rag/res")
         self.ne, self.df = {}, {}
         try:
@@ -158,6 +159,17 @@ class Dealer:
                 tks.append(t)
         return tks
 
+    def terms(self, tks):
+        """ The terms weights(tks) would weigh, without weighing them. """
+        res = []
+        for tk in tks:
+            tt = self.terms_cache_.get(tk)
+            if tt is None:
+                tt = self.tokenMerge(self.pretoken(tk, True))
+                self.terms_cache_.put(tk, tt)
+            res.extend(tt)
+        return res
+
     def weights(self, tks):
         def skill(t):
             if t not in self.sk:
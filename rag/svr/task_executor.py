@@ -20,10 +20,13 @@ import os
 import hashlib
 import copy
 import re
+import signal
 import sys
 import time
+import threading
 import traceback
 from functools import partial
+from queue import Queue
 
 from api.db.services.file2document_service import File2DocumentService
 from api.settings import retrievaler
@@ -42,19 +45,33 @@ from timeit import default_timer as timer
 from rag.utils import rmSpace, findMaxTm, num_tokens_from_string
 
 from rag.nlp import search, rag_tokenizer
+from deepdoc.vision import ort_session
 from io import BytesIO
 import pandas as pd
 
 from rag.app import laws, paper, presentation, manual, qa, table, book, resume, picture, naive, one
 
-from api.db import LLMType, ParserType
+from api.db import LLMType, ParserType, FileType
 from api.db.services.document_service import DocumentService
 from api.db.services.llm_service import LLMBundle
 from api.utils.file_utils import get_project_base_directory
 from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.embedding_cache import CHUNK_EMBD_CACHE
 
 BATCH_SIZE = 64
 
+# Staged pipeline mode: fetch -> chunk -> embedding -> index run in separate
+# worker threads connected by bounded queues.
+PIPELINE_MODE = int(os.environ.get("TASK_PIPELINE", 0))
+PIPELINE_QUEUE_SIZE = int(os.environ.get("TASK_PIPELINE_QUEUE_SIZE", 4))
+PIPELINE_WORKERS = {
+    "fetch": int(os.environ.get("TASK_FETCH_WORKERS", 2)),
+    "chunk": int(os.environ.get("TASK_CHUNK_WORKERS", 2)),
+    "embedding": int(os.environ.get("TASK_EMBEDDING_WORKERS", 2)),
+    "index": int(os.environ.get("TASK_INDEX_WORKERS", 2)),
+}
+PIPELINE_REPORT_INTERVAL = 60
+
 FACTORY = {
     "general": naive,
     ParserType.NAIVE.value: naive,
@@ -125,7 +142,70 @@ def get_minio_binary(bucket, name):
     return MINIO.get(bucket, name)
 
 
-def build(row):
+def incremental(row):
+    """
+    Re-parses only touch the changed chunks of the documents whose
+    parser_config asks for it. Tasks of spreadsheets cut by rows can't
+    tell which of the indexed chunks are theirs, so those are rebuilt.
+    """
+    if not row["parser_config"].get("incremental_reindex"):
+        return False
+    return row["type"] == FileType.PDF.value or row["parser_id"] != ParserType.TABLE.value
+
+
+def indexed_chunks(row):
+    """ _id => {img_id, index_md5_kwd} of the indexed chunks of the pages of row's document this task parses. """
+    idxnm = search.index_name(row["tenant_id"])
+    if not ELASTICSEARCH.indexExist(idxnm):
+        return {}
+    q = Q("bool", must=[Q("match", doc_id=row["doc_id"])])
+    if row["type"] == FileType.PDF.value:
+        rng = Q("range", page_num_int={"gte": row["from_page"] + 1, "lte": row["to_page"]})
+        if row["from_page"] == 0:
+            rng = rng | ~Q("exists", field="page_num_int")
+        q = Q("bool", must=[Q("match", doc_id=row["doc_id"])], filter=[rng])
+    res = {}
+    for hits in ELASTICSEARCH.scrollIter(pagesize=1000, q={"query": q.to_dict(), "sort": ["_doc"]},
+                                         idxnm=idxnm, src=["img_id", "index_md5_kwd"]):
+        for h in hits:
+            res[h["_id"]] = h["_source"]
+    return res
+
+
+def index_md5(d, row):
+    """
+    Digest of what gets indexed for chunk d besides its vector, and of the
+    embedding settings the vector comes from. The _id only covers the text.
+    """
+    fields = {k: v for k, v in d.items() if k not in ["image", "create_time", "create_timestamp_flt", "index_md5_kwd"]}
+    fields["embd_id"] = row["embd_id"]
+    fields["filename_embd_weight"] = row["parser_config"].get("filename_embd_weight", 0.1)
+    return hashlib.md5(json.dumps(fields, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+
+def diff_chunks(cks, existing):
+    """
+    Splits freshly built chunks against the indexed ones:
+    (chunks to index, number of unchanged chunks, their tokens, stale _id => img_id).
+    A chunk is unchanged when its text, its other indexed fields and its
+    embedding settings are, see index_md5().
+    """
+    new, unchanged, tk_count, seen = [], 0, 0, set()
+    for d in cks:
+        seen.add(d["_id"])
+        old = existing.get(d["_id"])
+        # an image the indexed chunk lacked has to be indexed too
+        if not old or old.get("index_md5_kwd") != d["index_md5_kwd"] \
+                or (d.get("img_id") and not old.get("img_id")):
+            new.append(d)
+            continue
+        unchanged += 1
+        tk_count += num_tokens_from_string(d["content_with_weight"])
+    stale = {id: old.get("img_id", "") for id, old in existing.items() if id not in seen}
+    return new, unchanged, tk_count, stale
+
+
+def build(row, binary=None, existing=None):
     if row["size"] > DOC_MAXIMUM_SIZE:
         set_progress(row["id"], prog=-1, msg="File size exceeds( <= %dMb )" %
                                              (int(DOC_MAXIMUM_SIZE / 1024 / 1024)))
@@ -139,10 +219,11 @@ def build(row):
     chunker = FACTORY[row["parser_id"].lower()]
     try:
         st = timer()
-        bucket, name = File2DocumentService.get_minio_address(doc_id=row["doc_id"])
-        binary = get_minio_binary(bucket, name)
-        cron_logger.info(
-            "From minio({}) {}/{}".format(timer() - st, row["location"], row["name"]))
+        if binary is None:
+            bucket, name = File2DocumentService.get_minio_address(doc_id=row["doc_id"])
+            binary = get_minio_binary(bucket, name)
+            cron_logger.info(
+                "From minio({}) {}/{}".format(timer() - st, row["location"], row["name"]))
         cks = chunker.chunk(row["name"], binary=binary, from_page=row["from_page"],
                             to_page=row["to_page"], lang=row["language"], callback=callback,
                             kb_id=row["kb_id"], parser_config=row["parser_config"], tenant_id=row["tenant_id"])
@@ -181,9 +262,17 @@ def build(row):
         d["_id"] = md5.hexdigest()
         d["create_time"] = str(datetime.datetime.now()).replace("T", " ")[:19]
         d["create_timestamp_flt"] = datetime.datetime.now().timestamp()
+        d["term_weights_with_weight"] = retrievaler.term_weights(d)
+        d["index_md5_kwd"] = index_md5(d, row)
         if not d.get("image"):
             docs.append(d)
             continue
+        if existing and existing.get(d["_id"], {}).get("img_id"):
+            # same content, same image already in minio
+            d["img_id"] = "{}-{}".format(row["kb_id"], d["_id"])
+            del d["image"]
+            docs.append(d)
+            continue
 
         output_buffer = BytesIO()
         if isinstance(d["image"], bytes):
@@ -214,29 +303,20 @@ def embedding(docs, mdl, parser_config={}, callback=None):
     batch_size = 32
     tts, cnts = [rmSpace(d["title_tks"]) for d in docs if d.get("title_tks")], [
         re.sub(r"</?(table|td|caption|tr|th)( [^<>]{0,12})?>", " ", d["content_with_weight"]) for d in docs]
-    tk_count = 0
+    # the document counts the tokens of cached texts too, though nobody is billed for them
+    tk_count, used_tokens = 0, 0
     if len(tts) == len(cnts):
-        tts_ = np.array([])
-        for i in range(0, len(tts), batch_size):
-            vts, c = mdl.encode(tts[i: i + batch_size])
-            if len(tts_) == 0:
-                tts_ = vts
-            else:
-                tts_ = np.concatenate((tts_, vts), axis=0)
-            tk_count += c
-            callback(prog=0.6 + 0.1 * (i + 1) / len(tts), msg="")
-        tts = tts_
-
-    cnts_ = np.array([])
-    for i in range(0, len(cnts), batch_size):
-        vts, c = mdl.encode(cnts[i: i + batch_size])
-        if len(cnts_) == 0:
-            cnts_ = vts
-        else:
-            cnts_ = np.concatenate((cnts_, vts), axis=0)
-        tk_count += c
-        callback(prog=0.7 + 0.2 * (i + 1) / len(cnts), msg="")
-    cnts = cnts_
+        vts, c, cached = CHUNK_EMBD_CACHE.encode(mdl, tts, batch_size,
+                                                 lambda i, n: callback(prog=0.6 + 0.1 * i / n, msg=""))
+        used_tokens += c
+        tk_count += c + sum([num_tokens_from_string(tts[i]) for i in cached])
+        tts = vts
+
+    vts, c, cached = CHUNK_EMBD_CACHE.encode(mdl, cnts, batch_size,
+                                             lambda i, n: callback(prog=0.7 + 0.2 * i / n, msg=""))
+    used_tokens += c
+    tk_count += c + sum([num_tokens_from_string(cnts[i]) for i in cached])
+    cnts = vts
 
     title_w = float(parser_config.get("filename_embd_weight", 0.1))
     vects = (title_w * tts + (1 - title_w) *
@@ -246,7 +326,7 @@ def embedding(docs, mdl, parser_config={}, callback=None):
     for i, d in enumerate(docs):
         v = vects[i].tolist()
         d["q_%d_vec" % len(v)] = v
-    return tk_count
+    return tk_count, used_tokens
 
 
 def run_raptor(row, chat_mdl, embd_mdl, callback=None):
@@ -285,11 +365,70 @@ def run_raptor(row, chat_mdl, embd_mdl, callback=None):
         d["content_with_weight"] = content
         d["content_ltks"] = rag_tokenizer.tokenize(content)
         d["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(d["content_ltks"])
+        d["term_weights_with_weight"] = retrievaler.term_weights(d)
         res.append(d)
         tk_count += num_tokens_from_string(content)
     return res, tk_count
 
 
+def embed_chunks(r, cks, embd_mdl, callback):
+    callback(
+        msg="Finished slicing files(%d). Start to embedding the content." %
+            len(cks))
+    st = timer()
+    try:
+        tk_count, used_tokens = embedding(cks, embd_mdl, r["parser_config"], callback)
+    except Exception as e:
+        callback(-1, "Embedding error:{}".format(str(e)))
+        cron_logger.error(str(e))
+        tk_count, used_tokens = 0, 0
+    cron_logger.info("Embedding elapsed({}): {:.2f}, {} tokens, {} billed".format(
+        r["name"], timer() - st, tk_count, used_tokens))
+    callback(msg="Finished embedding({:.2f})! Start to build index!".format(timer() - st))
+    return tk_count
+
+
+def index_chunks(r, cks, tk_count, callback, unchanged=0, stale=None):
+    init_kb(r)
+    chunk_count = len(set([c["_id"] for c in cks])) + unchanged
+    st = timer()
+
+    def progress(done, total):
+        callback(prog=0.8 + 0.1 * done / total, msg="")
+
+    es_r, size = ELASTICSEARCH.parallel_bulk(cks, search.index_name(r["tenant_id"]), progress)
+    el = max(timer() - st, 1e-6)
+    cron_logger.info("Indexing elapsed({}): {:.2f}, {} docs, {:.2f}MB, {:.1f} docs/s, {:.2f} MB/s".format(
+        r["name"], el, len(cks), size / 1024 / 1024, len(cks) / el, size / 1024 / 1024 / el))
+    if es_r:
+        callback(-1, "Index failure!")
+        ELASTICSEARCH.deleteByQuery(
+            Q("match", doc_id=r["doc_id"]), idxnm=search.index_name(r["tenant_id"]))
+        search.bump_kb_version(r["kb_id"])
+        cron_logger.error(str(es_r))
+    else:
+        if TaskService.do_cancel(r["id"]):
+            ELASTICSEARCH.deleteByQuery(
+                Q("match", doc_id=r["doc_id"]), idxnm=search.index_name(r["tenant_id"]))
+            search.bump_kb_version(r["kb_id"])
+            return
+        if stale:
+            ELASTICSEARCH.deleteByQuery(
+                Q("ids", values=list(stale.keys())), idxnm=search.index_name(r["tenant_id"]))
+            for id, img_id in stale.items():
+                if img_id:
+                    MINIO.rm(r["kb_id"], id)
+            cron_logger.info("Incremental({}): {} new, {} unchanged, {} stale chunks".format(
+                r["name"], len(cks), unchanged, len(stale)))
+        search.bump_kb_version(r["kb_id"])
+        callback(1., "Done!")
+        DocumentService.increment_chunk_num(
+            r["doc_id"], r["kb_id"], tk_count, chunk_count, 0)
+        cron_logger.info(
+            "Chunk doc({}), token({}), chunks({}), elapsed:{:.2f}".format(
+                r["id"], tk_count, len(cks), timer() - st))
+
+
 def main():
     rows = collect()
     if len(rows) == 0:
@@ -304,6 +443,7 @@ def main():
             cron_logger.error(str(e))
             continue
 
+        unchanged, stale = 0, None
         if r.get("task_type", "") == "raptor":
             try:
                 chat_mdl = LLMBundle(r["tenant_id"], LLMType.CHAT, llm_name=r["llm_id"], lang=r["language"])
@@ -314,55 +454,169 @@ def main():
                 continue
         else:
             st = timer()
-            cks = build(r)
+            existing = indexed_chunks(r) if incremental(r) else None
+            cks = build(r, existing=existing)
             cron_logger.info("Build chunks({}): {}".format(r["name"], timer() - st))
             if cks is None:
                 continue
-            if not cks:
+            if not cks and not existing:
                 callback(1., "No chunk! Done!")
                 continue
+            tk_count = 0
+            if existing is not None:
+                cks, unchanged, tk_count, stale = diff_chunks(cks, existing)
             # TODO: exception handler
             ## set_progress(r["did"], -1, "ERROR: ")
-            callback(
-                msg="Finished slicing files(%d). Start to embedding the content." %
-                    len(cks))
+            if cks:
+                tk_count += embed_chunks(r, cks, embd_mdl, callback)
+
+        index_chunks(r, cks, tk_count, callback, unchanged, stale)
+
+
+class PipelineStage:
+    """
+    A pool of worker threads that takes tasks from `in_q`, applies `func`
+    and hands the result to `out_q`. `func` returns None to drop a task.
+    """
+    def __init__(self, name, func, workers, in_q, out_q=None):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.in_q = in_q
+        self.out_q = out_q
+        self.lock = threading.Lock()
+        self.done = 0
+        self.failed = 0
+        self.busy = 0.
+        self.threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name="%s-%d" % (self.name, i), daemon=True)
+            t.start()
+            self.threads.append(t)
+        return self
+
+    def _run(self):
+        while True:
+            task = self.in_q.get()
             st = timer()
+            res, ok = None, True
             try:
-                tk_count = embedding(cks, embd_mdl, r["parser_config"], callback)
-            except Exception as e:
-                callback(-1, "Embedding error:{}".format(str(e)))
-                cron_logger.error(str(e))
-                tk_count = 0
-            cron_logger.info("Embedding elapsed({}): {:.2f}".format(r["name"], timer() - st))
-            callback(msg="Finished embedding({:.2f})! Start to build index!".format(timer() - st))
+                res = self.func(task)
+            except (Exception, SystemExit) as e:
+                # set_progress() raises SystemExit on canceled tasks.
+                ok = isinstance(e, SystemExit)
+                if not ok:
+                    cron_logger.error("Pipeline stage {}: {}".format(self.name, str(e)))
+                    traceback.print_exc()
+            finally:
+                close_connection()
+            with self.lock:
+                self.busy += timer() - st
+                if ok:
+                    self.done += 1
+                else:
+                    self.failed += 1
+            if res is not None and self.out_q is not None:
+                self.out_q.put(res)
+
+    def stats(self, elapsed):
+        with self.lock:
+            return "{}[workers:{}, queue:{}, done:{}, failed:{}, {:.2f} tasks/s, avg:{:.2f}s]".format(
+                self.name, self.workers, self.in_q.qsize(), self.done, self.failed,
+                self.done / max(elapsed, 1e-6), self.busy / max(self.done + self.failed, 1))
+
+
+def pipeline_fetch(task):
+    r = task["row"]
+    task["callback"] = callback = partial(set_progress, r["id"], r["from_page"], r["to_page"])
+    try:
+        task["embd_mdl"] = LLMBundle(r["tenant_id"], LLMType.EMBEDDING, llm_name=r["embd_id"], lang=r["language"])
+    except Exception as e:
+        callback(-1, msg=str(e))
+        cron_logger.error(str(e))
+        return
+    if r.get("task_type", "") == "raptor" or r["size"] > DOC_MAXIMUM_SIZE:
+        return task
 
-        init_kb(r)
-        chunk_count = len(set([c["_id"] for c in cks]))
-        st = timer()
-        es_r = ""
-        es_bulk_size = 16
-        for b in range(0, len(cks), es_bulk_size):
-            es_r = ELASTICSEARCH.bulk(cks[b:b + es_bulk_size], search.index_name(r["tenant_id"]))
-            if b % 128 == 0:
-                callback(prog=0.8 + 0.1 * (b + 1) / len(cks), msg="")
-
-        cron_logger.info("Indexing elapsed({}): {:.2f}".format(r["name"], timer() - st))
-        if es_r:
-            callback(-1, "Index failure!")
-            ELASTICSEARCH.deleteByQuery(
-                Q("match", doc_id=r["doc_id"]), idxnm=search.index_name(r["tenant_id"]))
-            cron_logger.error(str(es_r))
+    st = timer()
+    try:
+        bucket, name = File2DocumentService.get_minio_address(doc_id=r["doc_id"])
+        task["binary"] = get_minio_binary(bucket, name)
+    except Exception as e:
+        if re.search("(No such file|not found)", str(e)):
+            callback(-1, "Can not find file <%s>" % r["name"])
         else:
-            if TaskService.do_cancel(r["id"]):
-                ELASTICSEARCH.deleteByQuery(
-                    Q("match", doc_id=r["doc_id"]), idxnm=search.index_name(r["tenant_id"]))
-                continue
-            callback(1., "Done!")
-            DocumentService.increment_chunk_num(
-                r["doc_id"], r["kb_id"], tk_count, chunk_count, 0)
-            cron_logger.info(
-                "Chunk doc({}), token({}), chunks({}), elapsed:{:.2f}".format(
-                    r["id"], tk_count, len(cks), timer() - st))
+            callback(-1, f"Internal server error: %s" % str(e).replace("'", ""))
+        cron_logger.error("Fetch {}/{}: {}".format(r["location"], r["name"], str(e)))
+        return
+    cron_logger.info("From minio({}) {}/{}".format(timer() - st, r["location"], r["name"]))
+    return task
+
+
+def pipeline_chunk(task):
+    r, callback = task["row"], task["callback"]
+    if r.get("task_type", "") == "raptor":
+        try:
+            chat_mdl = LLMBundle(r["tenant_id"], LLMType.CHAT, llm_name=r["llm_id"], lang=r["language"])
+            task["cks"], task["tk_count"] = run_raptor(r, chat_mdl, task["embd_mdl"], callback)
+        except Exception as e:
+            callback(-1, msg=str(e))
+            cron_logger.error(str(e))
+            return
+        return task
+
+    st = timer()
+    existing = indexed_chunks(r) if incremental(r) else None
+    cks = build(r, task.pop("binary", None), existing)
+    cron_logger.info("Build chunks({}): {}".format(r["name"], timer() - st))
+    if cks is None:
+        return
+    if not cks and not existing:
+        callback(1., "No chunk! Done!")
+        return
+    if existing is not None:
+        cks, task["unchanged"], task["tk_count"], task["stale"] = diff_chunks(cks, existing)
+    task["cks"] = cks
+    return task
+
+
+def pipeline_embedding(task):
+    if "tk_count" not in task:
+        task["tk_count"] = embed_chunks(task["row"], task["cks"], task["embd_mdl"], task["callback"])
+    elif "stale" in task and task["cks"]:
+        task["tk_count"] += embed_chunks(task["row"], task["cks"], task["embd_mdl"], task["callback"])
+    return task
+
+
+def pipeline_index(task):
+    index_chunks(task["row"], task["cks"], task["tk_count"], task["callback"],
+                 task.get("unchanged", 0), task.get("stale"))
+
+
+def main_pipeline():
+    queues = [Queue(maxsize=PIPELINE_QUEUE_SIZE) for _ in range(4)]
+    stages = [
+        PipelineStage("fetch", pipeline_fetch, PIPELINE_WORKERS["fetch"], queues[0], queues[1]),
+        PipelineStage("chunk", pipeline_chunk, PIPELINE_WORKERS["chunk"], queues[1], queues[2]),
+        PipelineStage("embedding", pipeline_embedding, PIPELINE_WORKERS["embedding"], queues[2], queues[3]),
+        PipelineStage("index", pipeline_index, PIPELINE_WORKERS["index"], queues[3]),
+    ]
+    for stg in stages:
+        stg.start()
+
+    st = last_report = timer()
+    while True:
+        rows = collect()
+        # Blocks while the fetch queue is full so that tasks stay in redis
+        # until this executor has room for them.
+        for _, r in rows.iterrows():
+            queues[0].put({"row": r})
+        if timer() - last_report > PIPELINE_REPORT_INTERVAL:
+            last_report = timer()
+            cron_logger.info("Pipeline: " + " ".join([stg.stats(last_report - st) for stg in stages]))
+            cron_logger.info("ONNX sessions: " + json.dumps(ort_session.stats()))
 
 
 if __name__ == "__main__":
@@ -370,6 +624,11 @@ if __name__ == "__main__":
     peewee_logger.propagate = False
     peewee_logger.addHandler(database_logger.handlers[0])
     peewee_logger.setLevel(database_logger.level)
-
-    while True:
-        main()
+    # exit through sys.exit so that atexit handlers, e.g. the token usage flush, run
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+    if PIPELINE_MODE:
+        main_pipeline()
+    else:
+        while True:
+            main()
@@ -0,0 +1,390 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import base64
+import fcntl
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+from cachetools import TTLCache
+
+from api.utils.file_utils import get_project_base_directory
+from rag.settings import es_logger, cron_logger
+from rag.utils.redis_conn import REDIS_CONN
+
+
+def model_name(emb_mdl):
+    """ Name of the embedding model behind an LLMBundle or a bare model. """
+    nm = getattr(emb_mdl, "llm_name", None)
+    if nm:
+        return str(nm)
+    mdl = getattr(emb_mdl, "mdl", emb_mdl)
+    return type(mdl).__name__ + "/" + str(getattr(mdl, "model_name", ""))
+
+
+def model_key(emb_mdl):
+    """
+    Identity of the model behind an LLMBundle, see TenantLLMService.model_key:
+    the same name may be a different model for another tenant. None for a
+    bare model, whose vectors are not shared.
+    """
+    return getattr(emb_mdl, "model_key", None)
+
+
+def to_bytes(v):
+    return base64.b64encode(np.asarray(v, dtype=np.float32).tobytes()).decode("ascii")
+
+
+def from_bytes(s):
+    return np.frombuffer(base64.b64decode(s), dtype=np.float32)
+
+
+class QueryEmbeddingCache:
+    """
+    Embeddings of search questions, in an in-process LRU and, when Redis
+    is up, in Redis so that every server shares them. Keyed by tenant,
+    embedding model, version of the tenant's model settings and
+    whitespace-normalized question.
+    """
+    def __init__(self, maxsize=10000, ttl=3600, redis_ttl=24 * 3600):
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.redis_ttl = redis_ttl
+        self.lock = threading.Lock()
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(tenant_id, mdl_nm, txt, version=None):
+        txt = re.sub(r"\s+", " ", txt).strip()
+        return "qembd:" + hashlib.md5("\n".join([str(tenant_id), mdl_nm, str(version or ""), txt]).encode("utf-8")).hexdigest()
+
+    def get(self, k):
+        with self.lock:
+            if (self.local_hits + self.redis_hits + self.misses) % 1000 == 999:
+                es_logger.info("Query embedding cache: hits {}/{}, {} from redis, {} entries".format(
+                    self.local_hits + self.redis_hits, self.local_hits + self.redis_hits + self.misses,
+                    self.redis_hits, len(self.local)))
+            v = self.local.get(k)
+            if v is not None:
+                self.local_hits += 1
+                return v
+        v = REDIS_CONN.get(k) if self.redis_ttl > 0 and REDIS_CONN.is_alive() else None
+        with self.lock:
+            if v:
+                v = from_bytes(v)
+                if self.local.maxsize > 0:
+                    self.local[k] = v
+                self.redis_hits += 1
+                return v
+            self.misses += 1
+        return None
+
+    def put(self, k, v):
+        if self.local.maxsize > 0:
+            with self.lock:
+                self.local[k] = v
+        if self.redis_ttl > 0 and REDIS_CONN.is_alive():
+            REDIS_CONN.set(k, to_bytes(v), self.redis_ttl)
+
+    def encode_queries(self, emb_mdl, txt):
+        """ Same as emb_mdl.encode_queries(txt)[0], as float32, from cache when possible. """
+        k = self.key(getattr(emb_mdl, "tenant_id", ""), model_key(emb_mdl) or model_name(emb_mdl), txt,
+                     getattr(emb_mdl, "llm_version", None))
+        v = self.get(k)
+        if v is not None:
+            return v
+        v, _ = emb_mdl.encode_queries(txt)
+        v = np.asarray(v, dtype=np.float32)
+        self.put(k, v)
+        return v
+
+    def clear(self):
+        with self.lock:
+            self.local.clear()
+
+    def stats(self):
+        with self.lock:
+            total = self.local_hits + self.redis_hits + self.misses
+            return {"size": len(self.local), "maxsize": self.local.maxsize,
+                    "local_hits": self.local_hits, "redis_hits": self.redis_hits, "misses": self.misses,
+                    "hit_rate": (self.local_hits + self.redis_hits) / total if total else 0.}
+
+
+QUERY_EMBD_CACHE = QueryEmbeddingCache(
+    maxsize=int(os.environ.get("QUERY_EMBD_CACHE_SIZE", 10000)),
+    ttl=int(os.environ.get("QUERY_EMBD_CACHE_TTL", 3600)),
+    redis_ttl=int(os.environ.get("QUERY_EMBD_CACHE_REDIS_TTL", 24 * 3600)))
+
+
+class RedisEmbeddingStore:
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    def get_many(self, mdl_key, keys):
+        if not REDIS_CONN.is_alive():
+            return [None] * len(keys)
+        res = REDIS_CONN.mget(["cembd:%s:%s" % (mdl_key, k) for k in keys]) or [None] * len(keys)
+        return [from_bytes(v) if v else None for v in res]
+
+    def put_many(self, mdl_key, keys, vects):
+        if not REDIS_CONN.is_alive():
+            return
+        REDIS_CONN.mset({"cembd:%s:%s" % (mdl_key, k): to_bytes(v) for k, v in zip(keys, vects)}, self.ttl)
+
+
+class DiskEmbeddingStore:
+    """
+    One pair of files per model under `dir`: <model>.f32, the vectors back
+    to back, and <model>.idx, the dimension on the first line then one key
+    per vector. Vectors are appended before their keys, under a file lock,
+    so several task executors can share the directory.
+    """
+    def __init__(self, dir):
+        self.dir = dir
+        os.makedirs(dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.index = {}
+
+    def _load(self, mdl_key):
+        """ The dimension and key => row of a model, reading only the keys appended since the last call. """
+        fnm = os.path.join(self.dir, mdl_key + ".idx")
+        if not os.path.exists(fnm):
+            self.index.pop(mdl_key, None)
+            return 0, {}
+        size = os.path.getsize(fnm)
+        dim, idx, offset = self.index.get(mdl_key, (0, {}, 0))
+        if size == offset:
+            return dim, idx
+        if size < offset:
+            dim, idx, offset = 0, {}, 0
+        with open(fnm, "rb") as f:
+            f.seek(offset)
+            tail = f.read()
+        # the last line is either empty or being written
+        tail = tail[:tail.rfind(b"\n") + 1]
+        lines = tail.decode("utf-8").split("\n")[:-1]
+        if lines and not offset:
+            dim = int(lines.pop(0))
+        for k in lines:
+            idx[k] = len(idx)
+        offset += len(tail)
+        self.index[mdl_key] = (dim, idx, offset)
+        return dim, idx
+
+    def get_many(self, mdl_key, keys):
+        with self.lock:
+            dim, idx = self._load(mdl_key)
+        if not idx:
+            return [None] * len(keys)
+        vects = np.memmap(os.path.join(self.dir, mdl_key + ".f32"), dtype=np.float32, mode="r")
+        vects = vects[:len(vects) // dim * dim].reshape(-1, dim)
+        # keys another thread appends meanwhile may be beyond this map
+        return [np.array(vects[idx[k]]) if idx.get(k, len(vects)) < len(vects) else None for k in keys]
+
+    def put_many(self, mdl_key, keys, vects):
+        vects = np.asarray(vects, dtype=np.float32)
+        with self.lock, open(os.path.join(self.dir, mdl_key + ".idx"), "a+") as fi:
+            fcntl.flock(fi, fcntl.LOCK_EX)
+            try:
+                dim, idx = self._load(mdl_key)
+                # drop the keys a put that died was writing
+                fi.truncate(self.index[mdl_key][2] if mdl_key in self.index else 0)
+                if dim and dim != vects.shape[1]:
+                    cron_logger.warning("Embedding cache: dimension of {} changed, {} vs {}".format(mdl_key, dim, vects.shape[1]))
+                    return
+                keep = [i for i, k in enumerate(keys) if k not in idx]
+                if not keep:
+                    return
+                with open(os.path.join(self.dir, mdl_key + ".f32"), "ab") as fv:
+                    # drop vectors of a put that died before writing their keys
+                    fv.truncate(len(idx) * dim * 4)
+                    fv.write(vects[keep].tobytes())
+                if not dim:
+                    fi.write("%d\n" % vects.shape[1])
+                fi.write("".join([keys[i] + "\n" for i in keep]))
+            finally:
+                fcntl.flock(fi, fcntl.LOCK_UN)
+
+
+class RateLimiter:
+    """ At most `concurrency` calls at a time and `rpm` calls a minute, 0 for no limit. """
+    def __init__(self, concurrency=1, rpm=0):
+        self.sem = threading.BoundedSemaphore(max(1, concurrency))
+        self.rpm = rpm
+        self.lock = threading.Lock()
+        self.calls = deque()
+
+    def __enter__(self):
+        self.sem.acquire()
+        while self.rpm > 0:
+            with self.lock:
+                now = time.time()
+                while self.calls and now - self.calls[0] >= 60:
+                    self.calls.popleft()
+                if len(self.calls) < self.rpm:
+                    self.calls.append(now)
+                    break
+                wait = 60 - (now - self.calls[0])
+            time.sleep(wait)
+        return self
+
+    def __exit__(self, *args):
+        self.sem.release()
+
+
+# 本地模型并发没有收益
+LOCAL_EMBEDDINGS = {"DefaultEmbedding", "FastEmbed", "YoudaoEmbed", "InfinityEmbed"}
+EMBD_CONCURRENCY = int(os.environ.get("EMBD_CONCURRENCY", 4))
+EMBD_RPM = int(os.environ.get("EMBD_RPM", 0))
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def limiter(emb_mdl):
+    """ The RateLimiter shared by every model of the provider behind emb_mdl. """
+    provider = type(getattr(emb_mdl, "mdl", emb_mdl)).__name__
+    with _limiters_lock:
+        if provider not in _limiters:
+            _limiters[provider] = RateLimiter(1, 0) if provider in LOCAL_EMBEDDINGS \
+                else RateLimiter(EMBD_CONCURRENCY, EMBD_RPM)
+        return _limiters[provider]
+
+
+class ChunkEmbeddingCache:
+    """
+    Content addressed embeddings of chunk texts, so re-parsing a document
+    only embeds the texts the embedding model has never seen.
+    CHUNK_EMBD_CACHE selects where they live: disk (default), redis or
+    none. Redis keeps them without any size limit, next to the task queue.
+    """
+    def __init__(self, backend="disk", ttl=7 * 24 * 3600, dir=None):
+        self.store = None
+        if backend == "redis":
+            self.store = RedisEmbeddingStore(ttl)
+        elif backend == "disk":
+            self.store = DiskEmbeddingStore(dir or os.path.join(get_project_base_directory(), "embd_cache"))
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(txt):
+        return hashlib.md5(txt.encode("utf-8")).hexdigest()
+
+    def encode(self, emb_mdl, texts, batch_size=32, callback=None):
+        """
+        Same as emb_mdl.encode(texts) as a float32 matrix, computed for the
+        distinct texts not cached yet only, in batches of `batch_size` sent
+        concurrently within the limits of the provider (EMBD_CONCURRENCY,
+        EMBD_RPM). callback(done, total) is called after each batch.
+        Returns (vectors, used_tokens, cached): the tokens the provider
+        counted, and the indexes of the texts it was not sent.
+        """
+        keys = [self.key(t) for t in texts]
+        store = self.store if model_key(emb_mdl) else None
+        mdl_key = hashlib.md5(model_key(emb_mdl).encode("utf-8")).hexdigest() if store else ""
+        vects = [None] * len(texts)
+        if store:
+            try:
+                vects = store.get_many(mdl_key, keys)
+            except Exception as e:
+                cron_logger.warning("Embedding cache: " + str(e))
+
+        def encode_batch(batch):
+            with limiter(emb_mdl):
+                return emb_mdl.encode([texts[i] for _, i in batch])
+
+        computed = {}
+        sent = set()
+
+        def run(todo, done, total):
+            tk_count = 0
+            batches = [todo[b: b + batch_size] for b in range(0, len(todo), batch_size)]
+            futs = {EMBD_POOL.submit(encode_batch, batch): batch for batch in batches}
+            try:
+                for fut in as_completed(futs):
+                    batch = futs[fut]
+                    vts, c = fut.result()
+                    vts = np.asarray(vts, dtype=np.float32)
+                    for (k, i), v in zip(batch, vts):
+                        computed[k] = v
+                        sent.add(i)
+                    tk_count += c
+                    done += len(vts)
+                    if store:
+                        try:
+                            store.put_many(mdl_key, [k for k, _ in batch], vts)
+                        except Exception as e:
+                            cron_logger.warning("Embedding cache: " + str(e))
+                    if callback:
+                        callback(done, total)
+            finally:
+                for fut in futs:
+                    fut.cancel()
+            return tk_count
+
+        def missing():
+            todo = {}
+            for i, k in enumerate(keys):
+                if vects[i] is None and k not in computed and k not in todo:
+                    todo[k] = i
+            return list(todo.items())
+
+        todo = missing()
+        with self.lock:
+            self.misses += len(todo)
+            self.hits += len(texts) - len(todo)
+        tk_count = run(todo, 0, len(todo))
+
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32), tk_count, []
+        # the model decides the dimension, or the most of the cached vectors when nothing was computed
+        dims = [len(v) for v in computed.values()] or [len(v) for v in vects if v is not None]
+        dim = max(set(dims), key=dims.count)
+        stale = [i for i, v in enumerate(vects) if v is not None and len(v) != dim]
+        if stale:
+            cron_logger.warning("Embedding cache: {} cached vectors of {} are not {}-dimensional".format(
+                len(stale), model_key(emb_mdl), dim))
+            for i in stale:
+                vects[i] = None
+            todo = missing()
+            with self.lock:
+                self.misses += len(todo)
+                self.hits -= len(stale)
+            tk_count += run(todo, 0, len(todo))
+
+        res = np.empty((len(texts), dim), dtype=np.float32)
+        for i, (k, v) in enumerate(zip(keys, vects)):
+            res[i] = v if v is not None else computed[k]
+        return res, tk_count, [i for i in range(len(texts)) if i not in sent]
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.}
+
+
+EMBD_POOL = ThreadPoolExecutor(max_workers=int(os.environ.get("EMBD_WORKERS", 16)))
+CHUNK_EMBD_CACHE = ChunkEmbeddingCache(
+    os.environ.get("CHUNK_EMBD_CACHE", "disk").lower(),
+    ttl=int(os.environ.get("CHUNK_EMBD_CACHE_TTL", 7 * 24 * 3600)),
+    dir=os.environ.get("CHUNK_EMBD_CACHE_DIR"))
@@ -2,6 +2,8 @@ import re
 import json
 import time
 import copy
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import elasticsearch
 from elastic_transport import ConnectionTimeout
@@ -13,6 +15,12 @@ from rag.utils import singleton
 
 es_logger.info("Elasticsearch version: "+str(elasticsearch.__version__))
 
+BULK_MAX_BYTES = int(os.environ.get("ES_BULK_MAX_BYTES", 8 * 1024 * 1024))
+BULK_WORKERS = int(os.environ.get("ES_BULK_WORKERS", 4))
+BULK_RETRIES = int(os.environ.get("ES_BULK_RETRIES", 5))
+# Item status codes worth sending again: the cluster is busy, not the doc broken.
+BULK_RETRY_STATUS = {429, 502, 503, 504}
+
 
 @singleton
 class ESConnection:
@@ -149,6 +157,80 @@ class ESConnection:
 
         return res
 
+    def parallel_bulk(self, df, idx_nm=None, callback=None):
+        """
+        Upserts like bulk(), but batches are cut by payload bytes
+        (ES_BULK_MAX_BYTES) instead of doc count and up to ES_BULK_WORKERS
+        of them are in flight at once. Only the items that failed with a
+        retriable status are sent again, with exponential backoff.
+
+        Returns (errors, size): "id:error" for every doc that could not be
+        indexed and the bytes sent in the first pass.
+        callback(done, total) is called as batches finish.
+        """
+        idx_nm = self.idxnm if not idx_nm else idx_nm
+        batches, batch, batch_size, size = [], [], 0, 0
+        for d in df:
+            id = d["id"] if "id" in d else d["_id"]
+            doc = {k: v for k, v in d.items() if k not in ["id", "_id"]}
+            act = ({"update": {"_id": id, "_index": idx_nm}, "retry_on_conflict": 100},
+                   {"doc": doc, "doc_as_upsert": "true"})
+            sz = len(json.dumps(act, ensure_ascii=False, default=str).encode("utf-8"))
+            if batch and batch_size + sz > BULK_MAX_BYTES:
+                batches.append(batch)
+                batch, batch_size = [], 0
+            batch.append(act)
+            batch_size += sz
+            size += sz
+        if batch:
+            batches.append(batch)
+
+        res, done = [], 0
+        with ThreadPoolExecutor(max_workers=max(1, min(BULK_WORKERS, len(batches)))) as exe:
+            jobs = {exe.submit(self._bulk_batch, b, idx_nm): len(b) for b in batches}
+            for f in as_completed(jobs):
+                res.extend(f.result())
+                done += jobs[f]
+                if callback:
+                    callback(done, len(df))
+        return res, size
+
+    def _bulk_batch(self, batch, idx_nm):
+        res, errs = [], []
+        for i in range(BULK_RETRIES + 1):
+            if i > 0:
+                time.sleep(min(2 ** (i - 1), 30))
+            acts = [a for act in batch for a in act]
+            try:
+                if elasticsearch.__version__[0] < 8:
+                    r = self.es.bulk(index=idx_nm, body=acts, refresh=False, timeout="600s")
+                else:
+                    r = self.es.bulk(index=idx_nm, operations=acts, refresh=False, timeout="600s")
+            except Exception as e:
+                es_logger.warning("Fail to bulk: " + str(e))
+                if not re.search(r"(Timeout|time out)", str(e), re.IGNORECASE):
+                    self.conn()
+                errs = [str(act[0]["update"]["_id"]) + ":" + str(e) for act in batch]
+                continue
+            if not r["errors"]:
+                return res
+
+            retry, errs = [], []
+            for act, it in zip(batch, r["items"]):
+                if "error" not in it["update"]:
+                    continue
+                e = str(it["update"]["_id"]) + ":" + str(it["update"]["error"])
+                if it["update"].get("status") in BULK_RETRY_STATUS:
+                    retry.append(act)
+                    errs.append(e)
+                else:
+                    res.append(e)
+            if not retry:
+                return res
+            es_logger.warning("Bulk: retry {} of {} docs.".format(len(retry), len(batch)))
+            batch = retry
+        return res + errs
+
     def bulk4script(self, df):
         ids, acts = {}, []
         for d in df:
@@ -281,6 +363,25 @@ class ESConnection:
         es_logger.error("ES search timeout for 3 times!")
         raise Exception("ES search timeout.")
 
+    def mget(self, doc_ids, idxnm=None, src=None):
+        """ The found docs among doc_ids, shaped as search hits for getSource(). """
+        for i in range(3):
+            try:
+                res = self.es.mget(index=(self.idxnm if not idxnm else idxnm),
+                                   ids=doc_ids, _source=src)
+                return [dict(d, _score=None) for d in res["docs"] if d.get("found")]
+            except Exception as e:
+                es_logger.error(
+                    "ES mget exception: " +
+                    str(e) +
+                    "【Q】：" +
+                    str(doc_ids[:10]))
+                if str(e).find("Timeout") > 0:
+                    continue
+                raise e
+        es_logger.error("ES mget timeout for 3 times!")
+        raise Exception("ES mget timeout.")
+
     def updateByQuery(self, q, d):
         ubq = UpdateByQuery(index=self.idxnm).using(self.es).query(q)
         scripts = ""
@@ -424,15 +525,15 @@ class ESConnection:
         return rr
 
     def scrollIter(self, pagesize=100, scroll_time='2m', q={
-        "query": {"match_all": {}}, "sort": [{"updated_at": {"order": "desc"}}]}):
+        "query": {"match_all": {}}, "sort": [{"updated_at": {"order": "desc"}}]}, idxnm=None, src=None):
         for _ in range(100):
             try:
                 page = self.es.search(
-                    index=self.idxnm,
+                    index=(self.idxnm if not idxnm else idxnm),
                     scroll=scroll_time,
                     size=pagesize,
                     body=q,
-                    _source=None
+                    _source=src
                 )
                 break
             except Exception as e:
@@ -0,0 +1,160 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Keep-alive HTTP connections shared by every model provider in rag/llm, so
+that building a model object again does not cost a new TCP/TLS handshake.
+
+- http_client(base_url): one httpx.Client per host, for the SDKs taking one
+  (OpenAI, ZhipuAI). HTTP/2 when the h2 package is installed.
+- httpx_kwargs(): the same pool settings, for the SDKs building their own
+  httpx.Client (ollama), whose clients are then cached with shared(), an
+  LRU of HTTP_CLIENT_CACHE_SIZE clients; key by secret_key(api_key), never
+  by the key itself.
+- post(url, ...): requests.post over a pooled requests.Session.
+- stats(): requests and new connections per host.
+"""
+import hashlib
+import os
+import threading
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from cachetools import LRUCache
+from requests.adapters import HTTPAdapter
+
+HTTP_POOL_PER_HOST = int(os.environ.get("HTTP_POOL_PER_HOST", 32))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", 60))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 10))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 600))
+# clients kept by shared(), the least recently used one goes first
+HTTP_CLIENT_CACHE_SIZE = int(os.environ.get("HTTP_CLIENT_CACHE_SIZE", 256))
+ZHIPUAI_BASE_URL = "https://open.bigmodel.cn/api/paas/v4"
+try:
+    import h2  # noqa: F401
+    HTTP2 = int(os.environ.get("HTTP2", 1)) > 0
+except ImportError:
+    HTTP2 = False
+
+
+def host_of(url):
+    u = urlsplit(url or "")
+    return "%s://%s" % (u.scheme or "https", u.netloc) if u.netloc else ""
+
+
+class HttpStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def add(self, host, requests=0, connections=0):
+        with self.lock:
+            st = self.hosts.setdefault(host, {"requests": 0, "connections": 0})
+            st["requests"] += requests
+            st["connections"] += connections
+
+    def get(self):
+        with self.lock:
+            return {h: dict(st) for h, st in self.hosts.items()}
+
+
+HTTPX_STATS = HttpStats()
+
+
+def _on_request(request):
+    host = "%s://%s" % (request.url.scheme, request.url.netloc.decode("ascii"))
+    HTTPX_STATS.add(host, requests=1)
+
+    def trace(event, info):
+        if event == "connection.connect_tcp.complete":
+            HTTPX_STATS.add(host, connections=1)
+
+    request.extensions = dict(request.extensions, trace=trace)
+
+
+def httpx_kwargs():
+    return {
+        "limits": httpx.Limits(max_connections=HTTP_POOL_PER_HOST,
+                               max_keepalive_connections=HTTP_POOL_PER_HOST,
+                               keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+        "timeout": httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        "http2": HTTP2,
+        "event_hooks": {"request": [_on_request]},
+    }
+
+
+_lock = threading.Lock()
+_clients = LRUCache(maxsize=max(1, HTTP_CLIENT_CACHE_SIZE))
+
+
+def shared(key, factory):
+    """
+    The object factory() made the last time `key` was asked for, while it
+    is among the HTTP_CLIENT_CACHE_SIZE most recently used ones.
+    """
+    with _lock:
+        v = _clients.get(key)
+        if v is None:
+            v = _clients[key] = factory()
+        return v
+
+
+def secret_key(secret):
+    """ What to key a client by instead of the API key it was made with. """
+    return hashlib.md5(str(secret).encode("utf-8")).hexdigest()
+
+
+def http_client(base_url=None):
+    return shared(("httpx", host_of(base_url)), lambda: httpx.Client(**httpx_kwargs()))
+
+
+class _Adapter(HTTPAdapter):
+    def __init__(self):
+        super().__init__(pool_connections=HTTP_POOL_PER_HOST, pool_maxsize=HTTP_POOL_PER_HOST)
+        self.pools = {}
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        conn = super().get_connection_with_tls_context(request, verify, proxies, cert)
+        self.pools[host_of(request.url)] = conn
+        return conn
+
+    def get_connection(self, url, proxies=None):
+        conn = super().get_connection(url, proxies)
+        self.pools[host_of(url)] = conn
+        return conn
+
+
+SESSION = requests.Session()
+_ADAPTER = _Adapter()
+SESSION.mount("http://", _ADAPTER)
+SESSION.mount("https://", _ADAPTER)
+
+
+def post(url, **kwargs):
+    kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    return SESSION.post(url, **kwargs)
+
+
+def stats():
+    """ {host: {"requests": n, "connections": m}}; requests - connections were served by a kept-alive connection. """
+    res = HTTPX_STATS.get()
+    for host, pool in list(_ADAPTER.pools.items()):
+        st = res.setdefault(host, {"requests": 0, "connections": 0})
+        st["requests"] += pool.num_requests
+        st["connections"] += pool.num_connections
+    for st in res.values():
+        st["reused"] = max(0, st["requests"] - st["connections"])
+    return res